@@ -0,0 +1,105 @@
+import itertools
+import os
+import time
+import yaml
+
+from multiprocessing import Pool
+
+from .model import Model
+
+
+class BatchModelBuilder():
+    """Builds the models of a datasource for every combination of binnings
+       and model params. The datasource is histogrammed once per binning and
+       the histogram is shared by all model params, whose models are built
+       in a pool of worker processes."""
+
+    def __init__(self, datasource, binnings, model_params, column_names=None):
+        """binnings: dict of binnings by name, used in the model filenames.
+           model_params: list of ModelParams."""
+        self.__datasource = datasource
+        self.__binnings = binnings
+        self.__model_params = model_params
+        self.__column_names = column_names
+
+    @property
+    def binnings(self):
+        return self.__binnings
+
+    @property
+    def model_params(self):
+        return self.__model_params
+
+    @staticmethod
+    def filename(binning_name, model_params, binary=False):
+        return "%s_%s_%s_%s.%s" % (
+            binning_name,
+            model_params.pad_mode.name.lower(),
+            model_params.pad_value.name.lower(),
+            model_params.interpolation_mode.name.lower(),
+            "npz" if binary else "model")
+
+    def build(self, directory, workers=1, binary=False):
+        """Writes all models to directory, together with manifest.yaml that
+           lists, for each model, its binning, model params, file size and
+           the time spent histogramming, building and writing it. If binary,
+           the models are written without F, which is only interpolated
+           when they are loaded, so it is not part of the build time.
+           Returns the manifest entries."""
+        os.makedirs(directory, exist_ok=True)
+
+        tasks = []
+        histogram_times = {}
+        for name, binning in self.binnings.items():
+            start = time.time()
+            # normalized by Model.from_histogram
+            histogram = self.__datasource.get_histogram(binning)
+            histogram_times[name] = time.time() - start
+            for model_params in self.model_params:
+                tasks.append((histogram, model_params, self.__column_names,
+                              os.path.join(directory, self.filename(
+                                  name, model_params, binary)),
+                              binary))
+
+        if workers > 1:
+            with Pool(workers) as pool:
+                results = pool.starmap(_build_model, tasks)
+        else:
+            results = list(itertools.starmap(_build_model, tasks))
+
+        manifest = []
+        for (name, model_params), result in zip(
+                itertools.product(self.binnings, self.model_params),
+                results):
+            entry = {
+                "binning": name,
+                "pad_mode": model_params.pad_mode.name.lower(),
+                "pad_value": model_params.pad_value.name.lower(),
+                "interpolation": model_params.interpolation_mode.name.lower(),
+                "histogram_seconds": histogram_times[name]
+            }
+            entry.update(result)
+            manifest.append(entry)
+
+        with open(os.path.join(directory, "manifest.yaml"), "w") as f:
+            yaml.dump(manifest, f, default_flow_style=False)
+        return manifest
+
+
+def _build_model(histogram, model_params, column_names, filename, binary):
+    # builds and writes one model, timing each step
+    start = time.time()
+    model = Model.from_histogram(model_params, histogram, column_names)
+    if not binary:
+        # F is built on first access; build it here so that it is timed
+        # separately from pickling it
+        model.F
+    built = time.time()
+    model.to_file(filename, binary)
+    written = time.time()
+    return {
+        "model": os.path.basename(filename),
+        "build_seconds": built - start,
+        "write_seconds": written - built,
+        "size": os.path.getsize(filename)
+    }
@@ -1,10 +1,13 @@
+import os
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from time import time
-from sklearn.cluster import KMeans
+from .helper import arrays_digest
 from .helper import centering
 from .helper import to_dict
+from .sketches import QuantileSketch
 
 
 class Binning_Types(Enum):
@@ -12,6 +15,7 @@ class Binning_Types(Enum):
     IRREGULAR = 2
     CLUSTERED = 3
     G2PROGRESSION = 4
+    QUANTILE = 5
     USER = 98
     SUBBINNING = 99
 
@@ -22,28 +26,58 @@ class Pad_Modes(Enum):
 
 
 class Binning():
+    """Bin edges along each dimension. Binnings are immutable: the edges and
+       the derived arrays are read-only and shared by copies, and the
+       derived arrays are only computed on first access. Prefer the
+       per-dimension (separable) accessors over the dense volumes and
+       meshgrids, which hold prod(counts) values each."""
 
     def __init__(self, type, edges, random_seed=0):
         self.__type = type
-        self.__edges = list(np.copy(edges))
-        self.__counts = [len(x) - 1 for x in edges]
-        self.__domain = [x.max() for x in self.edges]
+        self.__edges = tuple(self.__readonly(x) for x in edges)
+        self.__counts = tuple(len(x) - 1 for x in self.__edges)
+        self.__domain = tuple(x.max() for x in self.__edges)
         self.__random_seed = random_seed
-        self.__distances = [edges_along_dim[1:] - edges_along_dim[:-1]
-                            for edges_along_dim in edges]
-        self.__centers = list(map(centering, edges))
-        self.__total_volume = np.prod([edges_along_dim[-1] - edges_along_dim[0]
-                                       for edges_along_dim in edges])
+        self.__cached = {}
 
-        mg_dists = np.meshgrid(*self.__distances, indexing='ij')
-        self.__volumes = mg_dists[0]
-        for mgd in mg_dists[1:]:
-            self.__volumes = np.multiply(self.__volumes, mgd)
+    @staticmethod
+    def __readonly(array):
+        if isinstance(array, np.ndarray) and not array.flags.writeable:
+            return array
+        array = np.array(array)
+        array.setflags(write=False)
+        return array
+
+    def __cache(self, name, compute):
+        if name not in self.__cached:
+            self.__cached[name] = self.__frozen(compute())
+        return self.__cached[name]
 
-        self.__meshgrids = np.meshgrid(*self.__centers, indexing='ij')
+    @staticmethod
+    def __frozen(value):
+        # read-only arrays, and tuples instead of lists
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+        elif isinstance(value, (list, tuple)):
+            value = tuple(Binning.__frozen(x) for x in value)
+        return value
+
+    def __getstate__(self):
+        # the dense derived arrays are cheap to recompute, don't pickle them
+        state = self.__dict__.copy()
+        state["_Binning__cached"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__edges = tuple(self.__readonly(x) for x in self.__edges)
 
     def copy(self):
-        return Binning(self.type, self.edges, self.random_seed)
+        """Returns a Binning sharing the edges and derived arrays."""
+        binning = Binning.__new__(Binning)
+        binning.__dict__.update(self.__dict__)
+        binning.__cached = dict(self.__cached)
+        return binning
 
     @property
     def type(self):
@@ -63,23 +97,57 @@ class Binning():
 
     @property
     def distances(self):
-        return self.__distances
+        return self.__cache("distances", lambda: [
+            edges_along_dim[1:] - edges_along_dim[:-1]
+            for edges_along_dim in self.edges])
 
     @property
     def centers(self):
-        return self.__centers
+        return self.__cache("centers",
+                            lambda: list(map(centering, self.edges)))
 
     @property
     def total_volume(self):
-        return self.__total_volume
+        return self.__cache("total_volume", lambda: np.prod([
+            edges_along_dim[-1] - edges_along_dim[0]
+            for edges_along_dim in self.edges]))
+
+    @property
+    def separable_volumes(self):
+        """The bin widths along each dimension, shaped to broadcast against
+           the others: their product is volumes."""
+        return self.__cache("separable_volumes",
+                            lambda: self.__separable(self.distances))
+
+    @property
+    def separable_centers(self):
+        """The bin centers along each dimension, shaped to broadcast against
+           the others, like a sparse meshgrids."""
+        return self.__cache("separable_centers",
+                            lambda: self.__separable(self.centers))
+
+    def __separable(self, arrays):
+        separable = []
+        for dim, array in enumerate(arrays):
+            shape = np.ones(self.dimensions, int)
+            shape[dim] = array.shape[0]
+            separable.append(array.reshape(shape))
+        return separable
 
     @property
     def volumes(self):
-        return self.__volumes
+        def compute():
+            separable = self.separable_volumes
+            volumes = separable[0]
+            for dists in separable[1:]:
+                volumes = np.multiply(volumes, dists)
+            return volumes
+        return self.__cache("volumes", compute)
 
     @property
     def meshgrids(self):
-        return self.__meshgrids
+        return self.__cache("meshgrids", lambda: np.meshgrid(
+            *self.centers, indexing='ij'))
 
     @property
     def dimensions(self):
@@ -89,6 +157,78 @@ class Binning():
     def domain(self):
         return self.__domain
 
+    def dim_indices(self, dim, x):
+        """Returns the index of the bin containing each coordinate in x along
+           dimension dim, as np.histogramdd assigns them: points on an inner
+           edge belong to the bin on their right, points on the last edge to
+           the last bin. Points below the binning get -1, points above it
+           and NaN get counts[dim].
+           Along evenly spaced dimensions the bin is computed arithmetically,
+           along the others by binary search on the edges."""
+        edges, regular = self.__lookup[dim]
+        x = np.asarray(x, dtype=float)
+        n = edges.shape[0] - 1
+        if not regular:
+            idx = np.searchsorted(edges, x, side='right')
+            idx[x == edges[-1]] -= 1
+            return idx - 1
+
+        # the arithmetic guess can be one bin off due to rounding; fix it
+        idx = np.floor((x - edges[0]) * (n / (edges[-1] - edges[0])))
+        idx = np.fmin(np.fmax(idx, 0), n - 1).astype(np.intp)
+        idx -= x < edges[idx]
+        idx += (x >= edges[idx + 1]) & ((idx < n - 1) | (x > edges[-1]))
+        idx[np.isnan(x)] = n
+        return idx
+
+    def locate(self, points):
+        """Returns the flat index of the bin containing each row of points,
+           an (N, d) array, or -1 for points outside the binning."""
+        points = np.asarray(points)
+        indices = [self.dim_indices(dim, points[:, dim])
+                   for dim in range(self.dimensions)]
+        inside = np.ones(points.shape[0], dtype=bool)
+        for idx, n in zip(indices, self.counts):
+            inside &= (idx >= 0) & (idx < n)
+        flat = np.full(points.shape[0], -1, dtype=np.intp)
+        flat[inside] = np.ravel_multi_index(
+            [idx[inside] for idx in indices], self.counts)
+        return flat
+
+    @property
+    def __lookup(self):
+        def compute():
+            lookup = []
+            for edges_along_dim in self.edges:
+                edges = np.asarray(edges_along_dim, dtype=float)
+                dists = np.diff(edges)
+                lookup.append((edges, bool(
+                    dists.shape[0] > 0 and dists[0] > 0 and
+                    np.allclose(dists, dists[0], rtol=1e-9, atol=0))))
+            return lookup
+        return self.__cache("lookup", compute)
+
+    def bin_centers(self, bin_indices):
+        """Returns the centers of the bins with the given flat indices,
+           one row per bin."""
+        return np.stack([
+            centers_along_dim[idx] for centers_along_dim, idx in
+            zip(self.centers, np.unravel_index(bin_indices, self.counts))
+        ], axis=-1)
+
+    def bin_volumes(self, bin_indices):
+        """Returns the volumes of the bins with the given flat indices."""
+        volumes = np.ones(np.shape(bin_indices))
+        for dists, idx in zip(self.distances,
+                              np.unravel_index(bin_indices, self.counts)):
+            volumes = volumes * dists[idx]
+        return volumes
+
+    @property
+    def digest(self):
+        """Content hash of the bin edges."""
+        return arrays_digest(self.edges)
+
     def to_dict(self):
         return to_dict(self, [
             "type",
@@ -158,33 +298,177 @@ class IrregularBinning(Binning):
 
 
 class ClusteredBinning(Binning):
-
-    def __init__(self, counts, src):
+    """Bins around the optimal 1-D k-means clusters of the data along each
+       dimension, with edges halfway between neighbouring cluster centers.
+       The clusters are found exactly by kmeans_1d, for all dimensions in
+       parallel threads. If prehistogram is given, the data is first
+       streamed into that many regular bins per dimension, and the means of
+       the occupied bins are clustered, weighted by their counts, which
+       needs neither the whole datasource in memory nor its sorting."""
+
+    def __init__(self, counts, src, prehistogram=None, workers=None):
         if isinstance(counts, int):
             counts = [counts] * len(src.domain)
         elif isinstance(counts, list) and isinstance(src.domain, list):
             if len(counts) != len(src.domain):
                 raise Exception("Dimensions of counts and domain mismatch.")
 
-        random_seed = np.random.randint(2**32-1)
-        edges = self.__clusteredBinEdgeGenerator(counts, src.domain,
-                                                 src.data, random_seed)
+        edges = self.__clusteredBinEdgeGenerator(counts, src, prehistogram,
+                                                 workers)
         super().__init__(type=Binning_Types.CLUSTERED,
-                         edges=edges,
-                         random_seed=random_seed)
+                         edges=edges)
 
-    def __clusteredBinEdgeGenerator(self, counts, domain, data,
-                                    random_seed):
-        def single_dim(count, domain, data1D):
-            kmeans = KMeans(n_clusters=count, init='k-means++',
-                            random_state=random_seed)
-            kmeans = kmeans.fit(data1D.reshape((data1D.shape[0], 1)))
-            centers = np.unique(kmeans.cluster_centers_.reshape((count,)))
-            return np.concatenate(([0], centering(centers), [domain]),
-                                  axis=None)
+    def __clusteredBinEdgeGenerator(self, counts, src, prehistogram,
+                                    workers):
+        columns = ClusteredBinning.weighted_values(src, prehistogram)
 
-        return [single_dim(c, d, col)
-                for c, d, col in zip(counts, domain, data.T)]
+        def single_dim(count, domain, column):
+            return ClusteredBinning.cluster_edges(count, domain, *column)
+
+        workers = min(workers or os.cpu_count() or 1, len(counts))
+        with ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(single_dim, counts, src.domain, columns))
+
+    @staticmethod
+    def cluster_edges(count, domain, values, weights):
+        """Returns the edges of count bins along one dimension, for the
+           sorted, distinct values with the given weights."""
+        centers = kmeans_1d(values, weights, count)
+        return np.concatenate(([0], centering(centers), [domain]), axis=None)
+
+    @staticmethod
+    def weighted_values(src, prehistogram=None):
+        """Returns the (values, weights) clustered along each dimension:
+           the distinct values of the data and their counts, or the means
+           and counts of the occupied bins of the prehistogram."""
+        if prehistogram is None:
+            return [np.unique(col, return_counts=True) for col in src.data.T]
+        return ClusteredBinning.__prehistogram(src, prehistogram)
+
+    @staticmethod
+    def __prehistogram(src, bin_count):
+        # count and sum the datapoints in regular bins along each dimension
+        domain = np.asarray(src.domain, dtype=float)
+        counts = np.zeros((len(domain), bin_count))
+        sums = np.zeros((len(domain), bin_count))
+        for chunk in src.iter_chunks():
+            for dim, col in enumerate(chunk.T):
+                idx = np.clip((col * (bin_count / domain[dim])).astype(np.intp),
+                              0, bin_count - 1)
+                counts[dim] += np.bincount(idx, minlength=bin_count)
+                sums[dim] += np.bincount(idx, weights=col, minlength=bin_count)
+        occupied = counts > 0
+        return [(s[o] / c[o], c[o]) for s, c, o in zip(sums, counts, occupied)]
+
+
+def kmeans_1d(values, weights, count):
+    """Returns the centers of the optimal clustering of the sorted, distinct
+       values with the given weights into at most count clusters, i.e. with
+       the least weighted sum of squared distances to the cluster centers.
+
+       Dynamic programming over the number of clusters: the best cost of
+       the first i values in m clusters is the least, over the start j of
+       the last cluster, of the best cost of the first j values in m - 1
+       clusters plus the cost of the cluster of values j to i. The best j
+       does not decrease with i, nor with m, so each layer is solved by
+       divide and conquer, vectorised over all subproblems of a recursion
+       level, in O(n log n) for n values."""
+    values = np.asarray(values, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    n = values.shape[0]
+    count = min(count, n)
+    if count < 1:
+        raise Exception("No values to cluster.")
+
+    # prefix sums of weights, weighted values and squares, with the values
+    # centered on their mean to limit cancellation
+    mean = np.average(values, weights=weights)
+    shifted = values - mean
+    W = np.concatenate(([0.0], np.cumsum(weights)))
+    S = np.concatenate(([0.0], np.cumsum(weights * shifted)))
+    Q = np.concatenate(([0.0], np.cumsum(weights * shifted ** 2)))
+
+    best = np.full(n + 1, np.inf)
+    best[1:] = Q[1:] - S[1:] ** 2 / W[1:]
+    starts = [np.zeros(n + 1, dtype=np.intp)]
+    for m in range(2, count + 1):
+        # the remaining count - m clusters need at least one value each
+        best, start = _kmeans_1d_layer(best, starts[-1], m, n - (count - m),
+                                       W, S, Q)
+        starts.append(start)
+
+    # follow the starts of the clusters back from the last value
+    bounds = [n]
+    for start in reversed(starts):
+        bounds.append(start[bounds[-1]])
+    bounds = bounds[::-1]
+    return np.array([
+        (S[i] - S[j]) / (W[i] - W[j]) for j, i in zip(bounds, bounds[1:])
+    ]) + mean
+
+
+def _kmeans_1d_layer(previous, previous_start, m, last, W, S, Q,
+                     batch_size=2**15):
+    # best costs and cluster starts of the first i values in m clusters,
+    # for i up to last; the pending subproblems of a recursion level are
+    # the ranges [ilo, ihi] of i whose best start lies in [jlo, jhi]
+    best = np.full(previous.shape[0], np.inf)
+    start = np.zeros(previous.shape[0], dtype=np.intp)
+    # cost of a cluster of values j to i - 1 after the best m - 1 clusters
+    # of the first j values: A[j] + Q[i] - (S[i] - S[j])^2 / (W[i] - W[j])
+    A = previous - Q
+    ilo, ihi = np.array([m]), np.array([last])
+    jlo, jhi = np.array([m - 1]), np.array([last - 1])
+    while ilo.shape[0]:
+        mid = (ilo + ihi) // 2
+        top = np.minimum(jhi, mid - 1)
+        low = np.minimum(np.maximum(jlo, previous_start[mid]), top)
+        lengths = top - low + 1
+
+        # subproblems in batches of about batch_size candidates, so that
+        # the temporary arrays stay in cache
+        ends = np.cumsum(lengths)
+        cuts = np.unique(np.concatenate((
+            [0], np.searchsorted(ends, np.arange(batch_size, ends[-1],
+                                                 batch_size)) + 1,
+            [mid.shape[0]])))
+        opt = np.empty(mid.shape[0], dtype=np.intp)
+        for first, end in zip(cuts[:-1], cuts[1:]):
+            batch = slice(first, end)
+            best[mid[batch]], opt[batch] = _kmeans_1d_best(
+                A, W, S, mid[batch], low[batch], lengths[batch])
+        best[mid] += Q[mid]
+        start[mid] = opt
+
+        left = ilo < mid
+        right = mid < ihi
+        ilo, ihi, jlo, jhi = (
+            np.concatenate((ilo[left], mid[right] + 1)),
+            np.concatenate((mid[left] - 1, ihi[right])),
+            np.concatenate((jlo[left], opt[right])),
+            np.concatenate((opt[left], jhi[right])))
+    return best, start
+
+
+def _kmeans_1d_best(A, W, S, mid, low, lengths):
+    # least cost and its first start j in [low, low + lengths) for each mid
+    offsets = np.cumsum(lengths) - lengths
+    j = np.arange(offsets[-1] + lengths[-1])
+    j -= np.repeat(offsets - low, lengths)
+    dS = np.repeat(S[mid], lengths)
+    dS -= S.take(j)
+    dS *= dS
+    dW = np.repeat(W[mid], lengths)
+    dW -= W.take(j)
+    dS /= dW
+    costs = A.take(j)
+    costs -= dS
+
+    least = np.minimum.reduceat(costs, offsets)
+    hits = np.flatnonzero(costs <= np.repeat(least, lengths))
+    segment = np.searchsorted(offsets, hits, side='right')
+    first = hits[np.concatenate(([True], segment[1:] != segment[:-1]))]
+    return least, j[first]
 
 
 class G2ProgressionBinning(Binning):
@@ -205,18 +489,65 @@ class G2ProgressionBinning(Binning):
                 for n, d in zip(counts, domain)]
 
 
+class QuantileBinning(Binning):
+    """Equi-depth binning: the edges are quantiles of the data along each
+       dimension, so that the bins hold about the same number of datapoints.
+       The quantiles come from a QuantileSketch per dimension, built from
+       src in one pass over its chunks, or given as sketches, e.g. merged
+       from partial sketches of parts of the data. Quantiles that coincide,
+       as for discrete data, yield a single edge, and thus fewer bins."""
+
+    def __init__(self, counts, domain, src=None, sketches=None, k=200,
+                 workers=None):
+        if isinstance(counts, int):
+            counts = [counts] * len(domain)
+        elif isinstance(counts, list) and isinstance(domain, list):
+            if len(counts) != len(domain):
+                raise Exception("Dimensions of counts and domain mismatch.")
+
+        random_seed = np.random.randint(2**32-1)
+        if sketches is None:
+            if src is None:
+                raise Exception("Either a datasource or sketches are required.")
+            sketches = QuantileSketch.sketch_datasource(src, k, random_seed,
+                                                        workers)
+        elif len(sketches) != len(domain):
+            raise Exception("Dimensions of sketches and domain mismatch.")
+
+        edges = self.__quantileBinEdgeGenerator(counts, domain, sketches)
+        super().__init__(type=Binning_Types.QUANTILE,
+                         edges=edges,
+                         random_seed=random_seed)
+
+    def __quantileBinEdgeGenerator(self, counts, domain, sketches):
+        return [QuantileBinning.quantile_edges(c, d, sketch)
+                for c, d, sketch in zip(counts, domain, sketches)]
+
+    @staticmethod
+    def quantile_edges(count, domain, sketch):
+        """Returns the edges of count bins along one dimension, from the
+           QuantileSketch of the data along it."""
+        inner = sketch.quantiles(np.linspace(0.0, 1.0, count + 1)[1:-1])
+        inner = inner[(inner > 0) & (inner < domain)]
+        return np.unique(np.concatenate(([0], inner, [domain]), axis=None))
+
+
 class BinningGenerator():
 
     @staticmethod
-    def generate(type, counts, domain, src=None, spread=0.3):
+    def generate(type, counts, domain, src=None, spread=0.3,
+                 prehistogram=None, workers=None, sketches=None):
         if type == Binning_Types.REGULAR:
             return RegularBinning(counts, domain)
         elif type == Binning_Types.IRREGULAR:
             return IrregularBinning(counts, domain, spread)
         elif type == Binning_Types.CLUSTERED:
-            return ClusteredBinning(counts, src)
+            return ClusteredBinning(counts, src, prehistogram, workers)
         elif type == Binning_Types.G2PROGRESSION:
             return G2ProgressionBinning(counts, domain)
+        elif type == Binning_Types.QUANTILE:
+            return QuantileBinning(counts, domain, src, sketches,
+                                   workers=workers)
         else:
             raise Exception("Invalid binning type.")
 
@@ -1,29 +1,110 @@
 import numpy as np
 import datetime
+import hashlib
+import os
 
+from multiprocessing import Pool
 from time import time
 
 from .binning import Binning
 from .binning import Binning_Types
+from .helper import atomic_write
+from .helper import centering
+from .helper import file_digest
 from .helper import objectview
+from .histogram import SparseHistogram
+from .model import Model
+from .preprocessors import BinnedDataSource
 from .preprocessors import DataSource
+from .preprocessors import DataSourceStream
+from .samplers import Sampler
+from .samplers import Sampling_Modes
+from .samplers import UniformSampler
 
 
 class BundleGenerator():
-    def __init__(self, model, binning):
+    def __init__(self, model, binning, chunk_size=2**20,
+                 sampling_mode=Sampling_Modes.ALIAS,
+                 bit_generator=np.random.PCG64):
+        """chunk_size: approximate number of points per call to the
+                       model function when computing probabilities.
+           sampling_mode: how bins are drawn according to their probability.
+           bit_generator: numpy.random.BitGenerator class seeded with the
+                          random seed of each generate call."""
         self.__model = model
         self.__binning = binning.copy()
-        self.__last_seed = None
+        self.__chunk_size = chunk_size
         self.__compute_probability_matrix()
-        pass
+        self.__setup(model.column_names, bit_generator,
+                     Sampler.build(sampling_mode,
+                                   self.sparse_probabilities[:, -1]))
+
+    def __setup(self, column_names, bit_generator, sampler):
+        self.__column_names = column_names
+        self.__bit_generator = bit_generator
+        self.__sampler = sampler
+        self.__uniform_sampler = UniformSampler(
+            int(np.prod(self.binning.counts)))
+        self.__last_seed = None
+
+    def to_file(self, filename):
+        """Saves the compiled generator (binning, probability matrix and
+           sampler tables) to an uncompressed npz file. The model itself is
+           not saved, as generating bundles no longer requires it."""
+        arrays = {
+            "binning_type": np.array(self.binning.type.value),
+            "random_seed": np.array(self.binning.random_seed),
+            "column_names": np.array(self.column_names),
+            "bin_indices": self.bin_indices,
+            "probabilities": self.sparse_probabilities,
+            "sampling_mode": np.array(self.sampler.mode.value)
+        }
+        for dim, edges_along_dim in enumerate(self.binning.edges):
+            arrays["edges_%d" % dim] = edges_along_dim
+        for name, table in self.sampler.tables.items():
+            arrays["sampler_%s" % name] = table
+        with open(filename, "wb") as f:
+            np.savez(f, **arrays)
 
-    def recommended_amount(self, real_histogram):
+    @staticmethod
+    def from_file(filename, bit_generator=np.random.PCG64):
+        """Loads a generator saved with to_file; its model is None."""
+        with np.load(filename) as f:
+            edges = [f["edges_%d" % dim]
+                     for dim in range(f["column_names"].shape[0])]
+            binning = Binning(Binning_Types(int(f["binning_type"])), edges,
+                              int(f["random_seed"]))
+            tables = {name[len("sampler_"):]: f[name] for name in f.files
+                      if name.startswith("sampler_")}
+            sampler = Sampler.from_tables(
+                Sampling_Modes(int(f["sampling_mode"])), tables)
+
+            bg = BundleGenerator.__new__(BundleGenerator)
+            bg.__model = None
+            bg.__binning = binning
+            bg.__bin_indices = f["bin_indices"]
+            bg.__probabilities = f["probabilities"]
+            bg.__setup(f["column_names"].tolist(), bit_generator, sampler)
+        return bg
+
+    def recommended_amount(self, real_histogram, target_quality=None):
         """real_histogram: the histogram of the model's source data
-                           binned with the new binning."""
-        min_prob = self.probabilities[
-            (self.probabilities[:, -1] > 0) *
-            (real_histogram.values.flatten() > 0),
-            -1].min()
+                           binned with the new binning.
+           target_quality: if given, the smallest amount whose expected best
+                           quality reaches it is returned instead."""
+        if target_quality is not None:
+            thresholds, qualities = self.__quality_steps(real_histogram)
+            reached = np.flatnonzero(qualities >= target_quality)
+            if not reached.size:
+                raise Exception(
+                    "Target quality %f can not be reached, the best "
+                    "expected quality is %f." % (target_quality,
+                                                 qualities[-1]))
+            # qualities[0] is the quality of generating no bundles at all
+            return int(np.concatenate(([0], thresholds))[reached[0]])
+
+        with_data, _ = self.__bins_with_data(real_histogram)
+        min_prob = self.sparse_probabilities[with_data, -1].min()
 
         if min_prob > 0:
             return int(np.ceil(1/min_prob))
@@ -33,11 +114,56 @@ class BundleGenerator():
     def expected_best_quality(self, amount, real_histogram):
         """real_histogram: the histogram of the model's source data
                            binned with the new binning."""
-        index = np.array([p * amount >= 1 or
-                          real_histogram.values.flatten()[i] == 0
-                          for i, p in enumerate(self.probabilities[:, -1])])
-        return self.binning.volumes.flatten()[index].sum() / \
-                    self.binning.total_volume
+        return self.expected_best_quality_curve([amount], real_histogram)[0]
+
+    def expected_best_quality_curve(self, amounts, real_histogram):
+        """Returns the expected best quality for each integer amount in
+           amounts, in one pass.
+           real_histogram: the histogram of the model's source data
+                           binned with the new binning."""
+        thresholds, qualities = self.__quality_steps(real_histogram)
+        return qualities[np.searchsorted(thresholds, amounts, side='right')]
+
+    def __quality_steps(self, real_histogram):
+        """The expected best quality is a step function of the amount: a bin
+           with data and probability p is covered once p * amount >= 1.
+           Returns the amounts at which such bins get covered, sorted, and
+           the quality before the first and after each step."""
+        probs = self.sparse_probabilities[:, -1]
+
+        # smallest integer amount with p * amount >= 1, correcting the
+        # rounding of 1 / p in both directions
+        thresholds = np.ceil(1.0 / probs)
+        thresholds[probs * (thresholds - 1) >= 1] -= 1
+        thresholds[probs * thresholds < 1] += 1
+
+        with_data, never = self.__bins_with_data(real_histogram)
+        thresholds = thresholds[with_data]
+        order = np.argsort(thresholds, kind='stable')
+
+        # the quality is one minus the share of the volume not covered yet;
+        # summing the uncovered volume rather than the covered one makes
+        # the quality exactly 1 once all bins with data are covered
+        volumes_to_cover = self.binning.bin_volumes(
+            self.bin_indices[with_data])[order]
+        uncovered = self.binning.bin_volumes(never).sum() + np.concatenate((
+            np.cumsum(volumes_to_cover[::-1])[::-1], [0.0]))
+        return thresholds[order], 1.0 - uncovered / self.binning.total_volume
+
+    def __bins_with_data(self, real_histogram):
+        """Returns which of bin_indices hold data in real_histogram, and the
+           flat indices of the bins holding data but no probability, which
+           are never covered. Sparse histograms are not made dense."""
+        if isinstance(real_histogram, SparseHistogram):
+            if real_histogram.border_value != 0.0:
+                raise Exception("Real histograms can not have a border "
+                                "value.")
+            data_bins = real_histogram.bin_indices[real_histogram.values > 0]
+        else:
+            data_bins = np.flatnonzero(real_histogram.values.ravel() > 0)
+        with_data = np.isin(self.bin_indices, data_bins, assume_unique=True)
+        never = np.setdiff1d(data_bins, self.bin_indices, assume_unique=True)
+        return with_data, never
 
     def __compute_probability_matrix(self):
         all_edges = [
@@ -46,82 +172,176 @@ class BundleGenerator():
                                 self.model.binning.edges)
         ]
 
-        # Create sub_edges for each bin and along each dimension.
-        sub_edges = []
-        for edges, coarse in zip(all_edges, self.binning.edges):
-            sub_edges.append(
-                [edges[(edges >= left) * (edges <= right)]
-                    for left, right in zip(coarse[:-1], coarse[1:])]
-            )
-
-        # sub_edges is an n-dim list of lists of arrays:
-        #   sub_edges[dim][bin_index] contains the sub edges along dimension
-        #   dim for bin with index bin_index along that dimension.
-
-        # Create a 1d list of all bin indices (along all dimensions)
-        bin_indices = [range(0, i) for i in self.binning.counts]
-        bin_indices = np.meshgrid(*bin_indices, indexing='ij')
-        bin_indices = list(zip(*[mg.flatten() for mg in bin_indices]))
-        # here bin_indices equals [ (x0, y0, z0), (x0, y0, z1), (x0, y1, z0) ... ]
-
-        # Probabilities is a matrix with one row per bin with the format:
+        # Restrict the merged edges to the range of the binning, so that each
+        # fine interval lies in exactly one bin. Along each dimension:
+        #   fine_centers[dim][j] is the center of the j-th fine interval,
+        #   owners[dim][j] is the index of the bin containing it.
+        fine_edges = [edges[(edges >= coarse[0]) * (edges <= coarse[-1])]
+                      for edges, coarse in zip(all_edges, self.binning.edges)]
+        fine_centers = list(map(centering, fine_edges))
+        fine_distances = [edges[1:] - edges[:-1] for edges in fine_edges]
+        owners = [self.binning.dim_indices(dim, edges[:-1])
+                  for dim, edges in enumerate(fine_edges)]
+
+        # The probability of a bin is the sum of the (clamped) model function
+        # over its fine sub-bins, weighted by their share of the bin volume.
+        # The fine grid is evaluated in chunks of whole bins along the first
+        # dimension, so each bin is summed within a single chunk, and only
+        # bins with a positive probability are kept.
+        stride = int(np.prod(self.binning.counts[1:]))
+        bin_indices, weights = [], []
+        for first, last in self.__chunks(owners[0], fine_centers[1:]):
+            grid = slice(first, last)
+            distances = np.meshgrid(fine_distances[0][grid],
+                                    *fine_distances[1:], indexing='ij')
+            owner_grids = np.meshgrid(owners[0][grid], *owners[1:],
+                                      indexing='ij')
+
+            volumes = distances[0]
+            for mgd in distances[1:]:
+                volumes = np.multiply(volumes, mgd)
+            total_volumes = self.binning.distances[0][owner_grids[0]]
+            for dists, mgi in zip(self.binning.distances[1:],
+                                  owner_grids[1:]):
+                total_volumes = np.multiply(total_volumes, dists[mgi])
+
+            # each chunk is evaluated once, so bypass the model's cache
+            alltF = self.model.F(*np.meshgrid(fine_centers[0][grid],
+                                              *fine_centers[1:],
+                                              indexing='ij'))
+            alltF = np.where(alltF > 0.0, alltF, 0.0)
+            alltF = alltF * (volumes / total_volumes)
+
+            # np.bincount accumulates in input order, which matches summing
+            # the sub-bins of each bin one at a time. The bins of a chunk
+            # have consecutive flat indices, starting at offset.
+            offset = owners[0][first] * stride
+            sums = np.bincount(
+                np.ravel_multi_index(owner_grids,
+                                     self.binning.counts).ravel() - offset,
+                weights=alltF.ravel())
+            positive = np.flatnonzero(sums > 0)
+            bin_indices.append(positive + offset)
+            weights.append(sums[positive])
+
+        # Probabilities is a matrix with one row per bin with positive
+        # probability, with the format:
         #   c_x, c_y, c_z, ... , probability
         # for each bin/row, where c_i indicates the center of the bin.
-        probabilities = np.zeros((len(bin_indices),
-                                  self.binning.dimensions + 1))
-        for i, bin_index in enumerate(bin_indices):
-            # Find center of current bin
-            probabilities[i, :-1] = [cpd[idx] for idx, cpd in
-                                     zip(bin_index, self.binning.centers)]
-
-            # Create sub-binning to calculate probability of bin
-            sub_binning = Binning(Binning_Types.SUBBINNING,
-                                  [sub_edges[dim][idx] for dim, idx in enumerate(bin_index)])
-
-            factors = sub_binning.volumes / sub_binning.total_volume
-            alltF = self.model.F(*sub_binning.meshgrids).flatten()
-            alltF = [x if x > 0.0 else 0.0 for x in alltF]
-            alltF = alltF * factors.flatten()
-            probabilities[i, -1] = sum(alltF)
-
-        probabilities[:, -1] /= np.linalg.norm(probabilities[:, -1], ord=1)
-        self.__probabilities = probabilities
-
-    def generate(self, amount, name="", random_seed=None):
-        def pick(p, n):
-            # picks n coordinates from the probability matrix p
-            return np.stack([p[x, :-1] for x in
-                             np.random.choice(range(p.shape[0]), p=p[:, -1], size=n)])
-        return self.__generate(amount, random_seed, pick, name)
-
-    def generate_uniform(self, amount, name="", random_seed=None):
-        def uniform_pick(p, n):
-            # picks n coordinates from the probability matrix p
-            return np.stack([p[x, :-1] for x in
-                             np.random.randint(p.shape[0], size=n)])
-        return self.__generate(amount, random_seed, uniform_pick, name)
-
-    def __generate(self, amount, random_seed, picker, name):
-        # generate bundles
-        if not random_seed:
+        self.__bin_indices = np.concatenate(bin_indices)
+        weights = np.concatenate(weights)
+        self.__probabilities = np.column_stack((
+            self.bin_centers(self.__bin_indices),
+            weights / np.linalg.norm(weights, ord=1)))
+
+    def __chunks(self, owners, other_centers):
+        """Splits the fine intervals along the first dimension into ranges
+        [first, last) of whole bins, each spanning about chunk_size points."""
+        slab = int(np.prod([len(c) for c in other_centers]))
+        bounds = np.searchsorted(owners, np.arange(self.binning.counts[0] + 1))
+        first = 0
+        for last in bounds[1:]:
+            if (last - first) * slab >= self.__chunk_size:
+                yield first, last
+                first = last
+        if first < bounds[-1]:
+            yield first, bounds[-1]
+
+    def bin_centers(self, bin_indices):
+        """Returns the centers of the bins with the given flat indices,
+           one row per bin."""
+        return self.binning.bin_centers(bin_indices)
+
+    def generate(self, amount, name="", random_seed=None, workers=1):
+        return self.__generate(amount, random_seed, self.sampler,
+                               self.centers.__getitem__, name, workers)
+
+    def generate_uniform(self, amount, name="", random_seed=None, workers=1):
+        return self.__generate(amount, random_seed, self.__uniform_sampler,
+                               self.bin_centers, name, workers)
+
+    def generate_stream(self, amount, chunk_size, name="", random_seed=None):
+        """Returns a DataSourceStream yielding amount bundles in arrays of at
+           most chunk_size rows. For a given random_seed, the bundles are the
+           same as the ones returned by generate, whatever the chunk_size."""
+        (rng,), info = self.__start(random_seed, name, [amount])
+
+        def chunks():
+            for indices in self.sampler.stream(amount, rng, chunk_size):
+                yield self.centers[indices]
+
+        return DataSourceStream(
+            info=info,
+            domain=list(self.binning.domain),
+            column_names=self.column_names,
+            chunks=chunks()
+        )
+
+    def generate_binned(self, amount, name="", random_seed=None):
+        """Generates amount bundles as a BinnedDataSource, storing how many
+           bundles fall in each bin instead of one row per bundle."""
+        (rng,), info = self.__start(random_seed, name, [amount])
+        counts = self.sampler.allocate(amount, rng)
+        nonzero = counts > 0
+        return BinnedDataSource(
+            info=info,
+            domain=list(self.binning.domain),
+            column_names=self.column_names,
+            binning=self.binning,
+            bin_indices=self.bin_indices[nonzero],
+            counts=counts[nonzero]
+        )
+
+    def __generate(self, amount, random_seed, sampler, lookup, name,
+                   workers):
+        """Draws indices with sampler and maps them to bundles with lookup.
+           With workers > 1, amount is split in contiguous shares that are
+           generated in a process pool, each with its own random stream.
+           The output is deterministic for a given random_seed and workers."""
+        shares = [amount // workers + (i < amount % workers)
+                  for i in range(workers)]
+        rngs, info = self.__start(random_seed, name, shares)
+
+        if workers > 1:
+            with Pool(workers) as pool:
+                indices = pool.starmap(_sample, [(sampler, share, rng)
+                                                 for share, rng in
+                                                 zip(shares, rngs)])
+        else:
+            indices = [_sample(sampler, amount, rngs[0])]
+        data = lookup(np.concatenate(indices))
+
+        ret = DataSource(
+            info=info,
+            domain=list(self.binning.domain),
+            column_names=self.column_names,
+            data=data
+        )
+        return ret
+
+    def __start(self, random_seed, name, shares):
+        # seeds one random generator per share and describes the generated
+        # data; a single share uses the seed directly, several shares use
+        # independent streams spawned from it
+        if random_seed is None:
             random_seed = np.random.randint(2**32-1)
-        np.random.seed(random_seed)
+        if len(shares) > 1:
+            seeds = np.random.SeedSequence(random_seed).spawn(len(shares))
+        else:
+            seeds = [random_seed]
+        rngs = [np.random.Generator(self.__bit_generator(s)) for s in seeds]
         self.__last_seed = random_seed
 
         mobj = {
             "name": name,
             "type": "Generated",
             "creation_date": datetime.datetime.now().isoformat(),
-            "random_seed": self.__last_seed
+            "random_seed": self.__last_seed,
+            "bit_generator": self.__bit_generator.__name__,
+            "workers": len(shares),
+            "worker_amounts": shares
         }
-
-        ret = DataSource(
-            info=objectview(mobj),
-            domain=self.binning.domain,
-            column_names=self.model.column_names,
-            data=picker(self.probabilities, amount)
-        )
-        return ret
+        return rngs, objectview(mobj)
 
     @property
     def model(self):
@@ -131,10 +351,80 @@ class BundleGenerator():
     def binning(self):
         return self.__binning
 
+    @property
+    def column_names(self):
+        return self.__column_names
+
     @property
     def probabilities(self):
+        """Dense matrix with one row per bin of the binning, in the format
+           of sparse_probabilities. It is built on each access."""
+        nbins = int(np.prod(self.binning.counts))
+        probabilities = np.zeros((nbins, self.binning.dimensions + 1))
+        probabilities[:, :-1] = self.bin_centers(np.arange(nbins))
+        probabilities[self.bin_indices, -1] = self.sparse_probabilities[:, -1]
+        return probabilities
+
+    @property
+    def sparse_probabilities(self):
         return self.__probabilities
 
+    @property
+    def bin_indices(self):
+        """Flat indices of the bins in sparse_probabilities."""
+        return self.__bin_indices
+
+    @property
+    def centers(self):
+        return self.sparse_probabilities[:, :-1]
+
+    @property
+    def sampler(self):
+        return self.__sampler
+
     @property
     def last_seed(self):
         return self.__last_seed
+
+
+class BundleGeneratorCache():
+    """A directory of compiled generators, keyed by the content hashes of
+       the model file and of the binning edges."""
+
+    def __init__(self, directory):
+        self.__directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def directory(self):
+        return self.__directory
+
+    def filename(self, model_filename, binning,
+                 sampling_mode=Sampling_Modes.ALIAS):
+        key = hashlib.sha256(("%s:%s:%s" % (
+            file_digest(model_filename), binning.digest, sampling_mode.name
+        )).encode()).hexdigest()
+        return os.path.join(self.directory, "%s.npz" % key)
+
+    def get(self, model_filename, binning, load_model=Model.from_file,
+            sampling_mode=Sampling_Modes.ALIAS,
+            bit_generator=np.random.PCG64):
+        """Returns the cached generator for the model file and binning. On a
+           miss, the model is loaded with load_model(model_filename) and the
+           newly built generator is added to the cache."""
+        filename = self.filename(model_filename, binning, sampling_mode)
+        if os.path.isfile(filename):
+            return BundleGenerator.from_file(filename, bit_generator)
+
+        bg = BundleGenerator(load_model(model_filename), binning,
+                             sampling_mode=sampling_mode,
+                             bit_generator=bit_generator)
+        with atomic_write(filename) as tmpname:
+            bg.to_file(tmpname)
+        return bg
+
+
+def _sample(sampler, amount, rng):
+    # draws amount bin indices in the smallest sufficient integer type
+    return sampler.sample(amount, rng).astype(
+        np.min_scalar_type(sampler.size - 1))
@@ -1,3 +1,16 @@
+import hashlib
+import importlib
+import os
+import tempfile
+import threading
+import numpy as np
+import yaml
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from enum import Enum
+
+
 class objectview(object):
     def __init__(self, d):
         self.__dict__ = d
@@ -14,4 +27,118 @@ def to_dict(obj, props):
             ret[p] = f(obj.__getattribute__(p))
         else:
             ret[p] = obj.__getattribute__(p)
-    return ret
\ No newline at end of file
+    return ret
+
+
+def file_digest(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+@contextmanager
+def atomic_write(filename):
+    """Yields the name of a temporary file, with the same extension, that
+       replaces filename once the block completes, so that concurrent
+       readers never see a partially written file. On error, the temporary
+       file is removed and filename is left untouched."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(suffix=os.path.splitext(filename)[1],
+                                   dir=directory)
+    os.close(fd)
+    try:
+        yield tmpname
+        os.replace(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+
+
+def arrays_digest(arrays):
+    """Content hash of a list of 1-D arrays, e.g. bin edges per dimension."""
+    h = hashlib.sha256()
+    for array in arrays:
+        h.update(np.float64(len(array)).tobytes())
+        h.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class LRUCache():
+    """A thread-safe mapping holding at most capacity entries, evicting the
+       least recently used one first."""
+
+    def __init__(self, capacity):
+        self.__capacity = capacity
+        self.__entries = OrderedDict()
+        self.__building = {}
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    @property
+    def hits(self):
+        return self.__hits
+
+    @property
+    def misses(self):
+        return self.__misses
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, create):
+        """Returns the entry for key, calling create() to build it on a
+           miss. Concurrent misses on the same key build it only once."""
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+                return self.__entries[key]
+            building = self.__building.setdefault(key, threading.Lock())
+
+        with building:
+            with self.__lock:
+                # another thread may have built it while we waited
+                if key in self.__entries:
+                    self.__entries.move_to_end(key)
+                    self.__hits += 1
+                    return self.__entries[key]
+                self.__misses += 1
+
+            try:
+                value = create()
+            except Exception:
+                with self.__lock:
+                    self.__building.pop(key, None)
+                raise
+
+            with self.__lock:
+                self.__entries[key] = value
+                self.__building.pop(key, None)
+                while len(self.__entries) > self.__capacity:
+                    self.__entries.popitem(last=False)
+        return value
+
+
+class SafeLoader(yaml.SafeLoader):
+    """yaml.SafeLoader that also reads the enums of this package, which
+       yaml.dump writes as python/object/apply tags. Any other python tag
+       is rejected."""
+
+
+def _construct_enum(loader, suffix, node):
+    module, _, name = suffix.rpartition(".")
+    cls = None
+    if module.split(".")[0] == __name__.split(".")[0]:
+        cls = getattr(importlib.import_module(module), name, None)
+    if not (isinstance(cls, type) and issubclass(cls, Enum)):
+        raise yaml.constructor.ConstructorError(
+            None, None, "unsafe tag %s" % node.tag, node.start_mark)
+    return cls(*loader.construct_sequence(node))
+
+
+SafeLoader.add_multi_constructor("tag:yaml.org,2002:python/object/apply:",
+                                 _construct_enum)
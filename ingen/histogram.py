@@ -1,5 +1,7 @@
+import os
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from .binning import BinningExtender
 
@@ -32,6 +34,77 @@ class Histogram():
         return self.__binning
 
 
+class SparseHistogram():
+    """A histogram storing only its nonzero bins, as sorted flat (C order)
+       bin indices and their values, so that its cost depends on the number
+       of occupied bins instead of the size of the binning. Bins that are
+       not stored are 0, except those on the border of the grid (first or
+       last bin along any dimension), which are border_value; padded
+       histograms use it for constant padding."""
+
+    def __init__(self, binning, bin_indices, values, border_value=0.0):
+        order = np.argsort(bin_indices, kind='stable')
+        self.__binning = binning
+        self.__bin_indices = np.asarray(bin_indices, dtype=np.int64)[order]
+        self.__values = np.asarray(values, dtype=float)[order]
+        self.__border_value = border_value
+
+    @staticmethod
+    def from_dense(histogram):
+        bin_indices = np.flatnonzero(histogram.values)
+        return SparseHistogram(histogram.binning, bin_indices,
+                               histogram.values.ravel()[bin_indices])
+
+    def to_dense(self):
+        return Histogram(self.binning, self.lookup(
+            np.arange(int(np.prod(self.binning.counts)))
+        ).reshape(self.binning.counts))
+
+    def normalize(self, ord=np.inf):
+        self.__values /= np.linalg.norm(self.__values, ord=ord)
+
+    def copy(self):
+        return SparseHistogram(self.binning.copy(), self.bin_indices,
+                               self.values, self.border_value)
+
+    @property
+    def values(self):
+        """Values of the stored bins."""
+        return self.__values
+
+    @property
+    def bin_indices(self):
+        return self.__bin_indices
+
+    @property
+    def border_value(self):
+        return self.__border_value
+
+    @property
+    def binning(self):
+        return self.__binning
+
+    def lookup(self, bin_indices):
+        """Returns the values of the bins with the given flat indices."""
+        bin_indices = np.asarray(bin_indices, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.bin_indices, bin_indices),
+                         max(self.bin_indices.shape[0] - 1, 0))
+        if self.bin_indices.shape[0]:
+            stored = self.bin_indices[pos] == bin_indices
+        else:
+            stored = np.zeros(bin_indices.shape, dtype=bool)
+        result = np.zeros(bin_indices.shape)
+        if self.border_value != 0.0:
+            border = np.zeros(bin_indices.shape, dtype=bool)
+            for idx, n in zip(np.unravel_index(bin_indices,
+                                               self.binning.counts),
+                              self.binning.counts):
+                border |= (idx == 0) | (idx == n - 1)
+            result[border] = self.border_value
+        result[stored] = self.values[pos[stored]]
+        return result
+
+
 class HistogramExtender():
     @staticmethod
     def __zero(values):
@@ -55,8 +128,61 @@ class HistogramExtender():
             return vector
         return np.pad(values, 1, pad_F)
 
+    @staticmethod
+    def __extend_sparse(histogram, extended_binning, pad_value):
+        counts = histogram.binning.counts
+        coords = np.unravel_index(histogram.bin_indices, counts)
+        extended = [np.ravel_multi_index([c + 1 for c in coords],
+                                         extended_binning.counts)]
+        values = [histogram.values]
+
+        border_value = 0.0
+        if (pad_value == Pad_Values.NEG_ONE):
+            border_value = -1.0
+        elif (pad_value in (Pad_Values.COPY, Pad_Values.NEG_COPY)):
+            # ghost bins copy the value of the closest bin in the grid, so
+            # only occupied bins on the border of the grid have nonzero
+            # ghosts; add them one dimension at a time, so that corners
+            # are reached through the ghosts added along earlier dimensions
+            border = np.zeros(histogram.bin_indices.shape, dtype=bool)
+            for c, n in zip(coords, counts):
+                border |= (c == 0) | (c == n - 1)
+            ghosts = [c[border] + 1 for c in coords]
+            ghost_values = histogram.values[border]
+            if (pad_value == Pad_Values.NEG_COPY):
+                ghost_values = -abs(ghost_values)
+            ghosts_only = np.zeros(ghost_values.shape, dtype=bool)
+            for dim, n in enumerate(counts):
+                added = []
+                for side, ghost in [(1, 0), (n, n + 1)]:
+                    on_side = ghosts[dim] == side
+                    moved = [g[on_side] for g in ghosts]
+                    moved[dim] = np.full(moved[dim].shape, ghost)
+                    added.append((moved, ghost_values[on_side]))
+                ghosts = [np.concatenate([g] + [m[d] for m, _ in added])
+                          for d, g in enumerate(ghosts)]
+                ghost_values = np.concatenate(
+                    [ghost_values] + [v for _, v in added])
+                ghosts_only = np.concatenate(
+                    [ghosts_only] +
+                    [np.ones(v.shape, dtype=bool) for _, v in added])
+            extended.append(np.ravel_multi_index(
+                [g[ghosts_only] for g in ghosts], extended_binning.counts))
+            values.append(ghost_values[ghosts_only])
+        elif (pad_value != Pad_Values.ZERO):
+            raise Exception('Invalid pad_value.')
+
+        return SparseHistogram(extended_binning, np.concatenate(extended),
+                               np.concatenate(values), border_value)
+
     @classmethod
     def extend(cls, histogram, pad_mode, pad_value):
+        if isinstance(histogram, SparseHistogram):
+            return cls.__extend_sparse(
+                histogram,
+                BinningExtender.extend(histogram.binning, pad_mode),
+                pad_value)
+
         if (pad_value == Pad_Values.ZERO):
             extended_values = cls.__zero(histogram.values)
         elif (pad_value == Pad_Values.NEG_ONE):
@@ -71,3 +197,158 @@ class HistogramExtender():
         extended_binning = BinningExtender.extend(histogram.binning,
                                                   pad_mode)
         return Histogram(extended_binning, extended_values)
+
+
+class HistogramEngine():
+    """Counts datapoints per bin of a binning, as np.histogramdd does, in
+       chunks of rows spread over a pool of threads. Along evenly spaced
+       dimensions the bin is computed arithmetically, along the others by
+       binary search on the edges. Counts are accumulated over any number
+       of add calls, so data can be histogrammed chunk by chunk.
+
+       The threads only locate the bins of their chunks; the bins located
+       by a round of chunks are then counted at once, into a single array
+       of counts. Memory thus grows with the number of bins once, not once
+       per thread, and the pool of threads is kept across add calls.
+
+       If sparse is set, only the counts of occupied bins are kept, and a
+       SparseHistogram is returned."""
+
+    def __init__(self, binning, chunk_size=2**20, workers=None,
+                 sparse=False):
+        self.__binning = binning
+        # like np.histogramdd, count outliers in an extra bin at both ends
+        # of each dimension, and drop them at the end
+        self.__shape = [n + 2 for n in binning.counts]
+        self.__chunk_size = chunk_size
+        self.__workers = workers or os.cpu_count() or 1
+        self.__pool = None
+        self.__sparse = sparse
+        if sparse:
+            self.__counts = (np.zeros(0, dtype=np.int64),
+                             np.zeros(0, dtype=np.int64))
+        else:
+            self.__counts = np.zeros(int(np.prod(self.__shape)),
+                                     dtype=np.int64)
+
+    @staticmethod
+    def for_chunks(binning, chunk_size, workers=None, sparse=False):
+        """Returns an engine that spreads each chunk of at most chunk_size
+           rows added over all its threads."""
+        workers = workers or os.cpu_count() or 1
+        return HistogramEngine(binning, max(1, -(-chunk_size // workers)),
+                               workers, sparse)
+
+    @property
+    def binning(self):
+        return self.__binning
+
+    @property
+    def counts(self):
+        """Number of datapoints added so far per bin; if sparse, a tuple of
+           the occupied flat bin indices and their counts."""
+        if self.__sparse:
+            return self.__counts
+        core = len(self.__shape) * (slice(1, -1),)
+        return self.__counts.reshape(self.__shape)[core]
+
+    def add(self, data, weights=None):
+        """Adds the datapoints in the rows of data; datapoints outside the
+           binning are ignored. weights: optional integer number of
+           datapoints each row stands for."""
+        starts = range(0, data.shape[0], self.__chunk_size)
+        for first in range(0, len(starts), self.__workers):
+            round_starts = starts[first:first + self.__workers]
+            if len(round_starts) > 1:
+                located = list(self.__executor().map(
+                    lambda start: self.__locate(data, weights, start),
+                    round_starts))
+            else:
+                located = [self.__locate(data, weights, start)
+                           for start in round_starts]
+            self.__counts = self.__add(self.__counts,
+                                       self.__count(located))
+
+    def __executor(self):
+        if self.__pool is None:
+            self.__pool = ThreadPoolExecutor(self.__workers)
+        return self.__pool
+
+    def histogram(self):
+        """Returns the density histogram of the data added so far."""
+        if self.__sparse:
+            bin_indices, counts = self.counts
+            return SparseHistogram(self.binning, bin_indices,
+                                   HistogramEngine.sparse_density(
+                                       self.binning, bin_indices, counts))
+        return Histogram(self.binning,
+                         HistogramEngine.density(self.binning, self.counts))
+
+    @staticmethod
+    def density(binning, counts):
+        """Converts counts per bin to the probability density, with the
+           same floating point operations as np.histogramdd."""
+        values = np.asarray(counts, dtype=float).reshape(binning.counts)
+        total = values.sum()
+        for dim, edges_along_dim in enumerate(binning.edges):
+            shape = np.ones(binning.dimensions, int)
+            shape[dim] = len(edges_along_dim) - 1
+            values = values / np.diff(edges_along_dim).reshape(shape)
+        values /= total
+        return values
+
+    @staticmethod
+    def sparse_density(binning, bin_indices, counts):
+        """Like density, for the counts of the given bins only; the values
+           are the same as those of the dense density."""
+        values = np.asarray(counts, dtype=float)
+        total = values.sum()
+        for idx, edges_along_dim in zip(
+                np.unravel_index(bin_indices, binning.counts), binning.edges):
+            values = values / np.diff(edges_along_dim)[idx]
+        values /= total
+        return values
+
+    def __add(self, counts, more):
+        if not self.__sparse:
+            counts += more
+            return counts
+        bin_indices, inverse = np.unique(
+            np.concatenate((counts[0], more[0])), return_inverse=True)
+        return bin_indices, np.bincount(
+            inverse, weights=np.concatenate((counts[1], more[1])),
+            minlength=bin_indices.shape[0]).astype(np.int64)
+
+    def __locate(self, data, weights, first):
+        # flat bin indices, and weights, of the rows of one chunk; if
+        # sparse, the outliers are dropped and the indices are into the
+        # binning, otherwise into the grid with the outlier bins
+        rows = slice(first, first + self.__chunk_size)
+        # shift by one to count the outliers below in bin 0
+        indices = [self.binning.dim_indices(dim, data[rows, dim]) + 1
+                   for dim in range(len(self.__shape))]
+        chunk_weights = None if weights is None else weights[rows]
+        if not self.__sparse:
+            return np.ravel_multi_index(indices, self.__shape), chunk_weights
+        inside = np.ones(indices[0].shape[0], dtype=bool)
+        for idx, n in zip(indices, self.__shape):
+            inside &= (idx > 0) & (idx < n - 1)
+        flat = np.ravel_multi_index([idx[inside] - 1 for idx in indices],
+                                    [n - 2 for n in self.__shape])
+        return flat, None if weights is None else chunk_weights[inside]
+
+    def __count(self, located):
+        # counts of the bins located in a round of chunks
+        flat = np.concatenate([f for f, _ in located])
+        weights = None
+        if located[0][1] is not None:
+            weights = np.concatenate([w for _, w in located])
+        if self.__sparse:
+            bin_indices, flat = np.unique(flat, return_inverse=True)
+            size = bin_indices.shape[0]
+        else:
+            size = self.__counts.shape[0]
+        counts = np.bincount(flat, weights=weights, minlength=size)
+        if weights is not None:
+            counts = counts.astype(np.int64)
+        return (bin_indices, counts) if self.__sparse else counts
@@ -0,0 +1,267 @@
+import itertools
+import numpy as np
+import os
+import pickle
+import warnings
+
+from scipy.interpolate import LinearNDInterpolator
+from scipy.interpolate import RBFInterpolator
+from scipy.spatial import Delaunay
+
+from .helper import LRUCache
+from .helper import arrays_digest
+from .helper import atomic_write
+
+
+class MultilinearInterpolator():
+    """Multilinear interpolation of values given on a rectilinear grid.
+
+       The cell containing each query point is found with one searchsorted
+       per dimension, so building is free and evaluation is linear in the
+       number of query points. Points outside the grid evaluate to NaN.
+       Like the scipy interpolators, it is called with one array of
+       coordinates per dimension."""
+
+    def __init__(self, axes, values):
+        """axes: list with the sorted grid coordinates along each dimension,
+           values: array of shape [len(axis) for axis in axes]."""
+        self.__axes = [np.asarray(axis, dtype=float) for axis in axes]
+        self.__values = np.asarray(values, dtype=float)
+
+    @property
+    def axes(self):
+        return self.__axes
+
+    @property
+    def values(self):
+        return self.__values
+
+    def __call__(self, *coords):
+        coords = np.broadcast_arrays(*[np.asarray(c, dtype=float)
+                                       for c in coords])
+        shape = coords[0].shape
+        counts = [axis.shape[0] for axis in self.axes]
+        strides = [int(np.prod(counts[dim + 1:]))
+                   for dim in range(len(counts))]
+
+        # lower corner of the containing cell and position inside it
+        base = np.zeros(coords[0].size, dtype=np.intp)
+        fractions = []
+        outside = np.zeros(coords[0].size, dtype=bool)
+        for axis, stride, x in zip(self.axes, strides, coords):
+            x = x.ravel()
+            idx = np.clip(np.searchsorted(axis, x, side='right') - 1,
+                          0, axis.shape[0] - 2)
+            fractions.append((x - axis[idx]) / (axis[idx + 1] - axis[idx]))
+            outside |= (x < axis[0]) | (x > axis[-1]) | np.isnan(x)
+            base += idx * stride
+
+        result = np.zeros(base.shape[0])
+        for corner in itertools.product((0, 1), repeat=len(self.axes)):
+            weights = np.ones(base.shape[0])
+            offset = 0
+            for upper, t, stride in zip(corner, fractions, strides):
+                weights *= t if upper else 1.0 - t
+                offset += upper * stride
+            result += weights * self._lookup(base + offset)
+
+        result[outside] = np.nan
+        return result.reshape(shape)
+
+    def _lookup(self, flat_indices):
+        # grid values at the given flat (C order) indices
+        return self.values.ravel()[flat_indices]
+
+
+class SparseMultilinearInterpolator(MultilinearInterpolator):
+    """Multilinear interpolation of the values of a SparseHistogram over its
+       bin centers. Only the occupied bins are stored, so the cost depends
+       on them and on the query points, not on the size of the grid."""
+
+    def __init__(self, histogram):
+        super().__init__(histogram.binning.centers, histogram.values)
+        self.__histogram = histogram
+
+    @property
+    def histogram(self):
+        return self.__histogram
+
+    def _lookup(self, flat_indices):
+        return self.histogram.lookup(flat_indices)
+
+
+class LocalRbfInterpolator():
+    """Radial basis function interpolation where each query point only uses
+       its nearest data points. Instead of one dense N x N system, small
+       systems of size neighbors are solved, so models with many bins stay
+       tractable. Query points are evaluated in chunks of chunk_size.
+
+       The kernels follow scipy.interpolate.Rbf: "linear" and
+       "multiquadric", the latter with the same default shape parameter,
+       and no polynomial term is added, so with all points as neighbors
+       the interpolant is that of Rbf.
+       The scipy interpolator is built on first call and not pickled."""
+
+    def __init__(self, points, values, kernel, neighbors=32,
+                 chunk_size=2**16):
+        """points: array of shape (N, d), values: array of shape (N,)."""
+        self.__points = np.asarray(points, dtype=float)
+        self.__values = np.asarray(values, dtype=float)
+        self.__kernel = kernel
+        self.__neighbors = min(neighbors, self.__points.shape[0])
+        self.__chunk_size = chunk_size
+        self.__rbf = None
+
+    @property
+    def points(self):
+        return self.__points
+
+    @property
+    def values(self):
+        return self.__values
+
+    @property
+    def kernel(self):
+        return self.__kernel
+
+    @property
+    def neighbors(self):
+        return self.__neighbors
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_LocalRbfInterpolator__rbf"] = None
+        return state
+
+    def __build(self):
+        # scipy.interpolate.Rbf's default epsilon: the average distance
+        # between points, based on their bounding hypercube
+        n, d = self.points.shape
+        extent = self.points.max(axis=0) - self.points.min(axis=0)
+        epsilon = np.power(np.prod(extent[extent > 0]) / n, 1.0 / d)
+        # Rbf solves the same systems, without a polynomial (degree -1),
+        # which RBFInterpolator warns may not be uniquely solvable
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", "`degree` should not be below")
+            self.__rbf = RBFInterpolator(self.points, self.values,
+                                         neighbors=self.neighbors,
+                                         kernel=self.kernel,
+                                         epsilon=1.0 / epsilon, degree=-1)
+
+    def __call__(self, *coords):
+        if self.__rbf is None:
+            self.__build()
+        coords = np.broadcast_arrays(*[np.asarray(c, dtype=float)
+                                       for c in coords])
+        queries = np.stack([c.ravel() for c in coords], axis=-1)
+        result = np.empty(queries.shape[0])
+        for first in range(0, queries.shape[0], self.__chunk_size):
+            chunk = slice(first, first + self.__chunk_size)
+            result[chunk] = self.__rbf(queries[chunk])
+        return result.reshape(coords[0].shape)
+
+
+class GeometryCache():
+    """Delaunay triangulations of rectilinear grids, keyed by the content
+       hash of the grid coordinates, so that interpolators over the same
+       (extended) binning share one. At most capacity triangulations are
+       kept in memory. If a directory is set, they are also pickled there
+       and reused across runs."""
+
+    def __init__(self, capacity=8, directory=None):
+        self.__triangulations = LRUCache(capacity)
+        self.directory = directory
+
+    @property
+    def directory(self):
+        return self.__directory
+
+    @directory.setter
+    def directory(self, directory):
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.__directory = directory
+
+    @property
+    def hits(self):
+        return self.__triangulations.hits
+
+    @property
+    def misses(self):
+        return self.__triangulations.misses
+
+    def triangulation(self, axes, known=None):
+        """Returns the Delaunay triangulation of the tensor grid with the
+           given coordinates along each dimension, its points in C order.
+           known: a triangulation of the grid at hand, e.g. unpickled, to
+                  cache instead of building one."""
+        key = arrays_digest(axes)
+        if known is not None:
+            return self.__triangulations.get(key, lambda: known)
+        return self.__triangulations.get(key, lambda: self.__build(key, axes))
+
+    def __build(self, key, axes):
+        filename = None
+        if self.directory is not None:
+            filename = os.path.join(self.directory, "%s.tri" % key)
+            if os.path.isfile(filename):
+                with open(filename, "rb") as f:
+                    return pickle.load(f)
+
+        triangulation = Delaunay(np.stack(
+            [x.ravel() for x in np.meshgrid(*axes, indexing='ij')], axis=-1))
+
+        if filename is not None:
+            with atomic_write(filename) as tmpname:
+                with open(tmpname, "wb") as f:
+                    pickle.dump(triangulation, f)
+        return triangulation
+
+
+geometry_cache = GeometryCache()
+
+
+class GridLinearInterpolator():
+    """Piecewise linear interpolation of values given on a rectilinear grid,
+       over the Delaunay triangulation of the grid points, as done by
+       scipy's LinearNDInterpolator. The triangulation is taken from
+       geometry_cache, so interpolators over the same grid only differ in
+       their values. It is pickled with the interpolator, as building it
+       is the costly part, and shared through geometry_cache again once
+       unpickled."""
+
+    def __init__(self, axes, values):
+        """axes: list with the sorted grid coordinates along each dimension,
+           values: array of shape [len(axis) for axis in axes]."""
+        self.__axes = [np.asarray(axis, dtype=float) for axis in axes]
+        self.__values = np.asarray(values, dtype=float)
+        self.__interpolator = self.__build()
+
+    @property
+    def axes(self):
+        return self.__axes
+
+    @property
+    def values(self):
+        return self.__values
+
+    @property
+    def triangulation(self):
+        return self.__interpolator.tri
+
+    def __getstate__(self):
+        return {"axes": self.axes, "values": self.values,
+                "triangulation": self.triangulation}
+
+    def __setstate__(self, state):
+        self.__axes = state["axes"]
+        self.__values = state["values"]
+        self.__interpolator = self.__build(state["triangulation"])
+
+    def __build(self, triangulation=None):
+        return LinearNDInterpolator(
+            geometry_cache.triangulation(self.axes, triangulation),
+            self.values.ravel())
+
+    def __call__(self, *coords):
+        return self.__interpolator(*coords)
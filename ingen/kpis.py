@@ -1,15 +1,36 @@
 import numpy as np
 
+from .histogram import SparseHistogram
+
 class KPIs():
     def __init__(self, hist1, hist2):
         """hist1 is the histogram of the data the model is derived from,
            hist2 is the histogram of the newly generated data.
-           Note: both must be using the same binning!"""
+           Note: both must be using the same binning!
+           If either is a SparseHistogram, only the bins occupied in one of
+           them are compared; all other bins are empty in both."""
         self.__h1 = hist1           # Model Source, realH
         self.__h2 = hist2           # ndH, generated
 
-        self.__h1f = hist1.values.flatten()
-        self.__h2f = hist2.values.flatten()
+        if (isinstance(hist1, SparseHistogram) or
+                isinstance(hist2, SparseHistogram)):
+            sparse1, sparse2 = [
+                h if isinstance(h, SparseHistogram)
+                else SparseHistogram.from_dense(h) for h in (hist1, hist2)]
+            union = np.union1d(sparse1.bin_indices, sparse2.bin_indices)
+            self.__h1f = sparse1.lookup(union)
+            self.__h2f = sparse2.lookup(union)
+            self.__bin_vols = hist2.binning.bin_volumes(union)
+            # volume of the bins empty in both, whose quality is 1
+            self.__empty_volume = 0.0
+            if union.shape[0] < np.prod(hist2.binning.counts):
+                self.__empty_volume = max(
+                    hist2.binning.total_volume - self.__bin_vols.sum(), 0.0)
+        else:
+            self.__h1f = hist1.values.flatten()
+            self.__h2f = hist2.values.flatten()
+            self.__bin_vols = None
+            self.__empty_volume = 0.0
 
         self.__diff = (self.__h2f - self.__h1f)
 
@@ -25,20 +46,26 @@ class KPIs():
                 return 0
             return 1 - abs(delta) / r
 
-        def quality(index):
-            if not any(index):
+        def quality(index, empty_volume=0.0):
+            if not any(index) and not empty_volume:
                 return 2.0
             else:
-                bin_vols = self.__h2.binning.volumes.flatten()
+                bin_vols = self.__bin_vols
+                if bin_vols is None:
+                    bin_vols = self.__h2.binning.volumes.flatten()
                 pairs = zip(self.__h1f[index],
                             self.__diff[index],
                             bin_vols[index])
-                return sum([get_quality(r, delta) * vol
-                            for r, delta, vol in pairs]) / bin_vols[index].sum()
+                total = sum([get_quality(r, delta) * vol
+                             for r, delta, vol in pairs])
+                if empty_volume:
+                    return ((total + empty_volume) /
+                            (bin_vols[index].sum() + empty_volume))
+                return total / bin_vols[index].sum()
 
         abi = [True] * self.__h1f.size
         nebi = self.__h1f > 0
         ebi = self.__h1f == 0
 
-        return (quality(abi), quality(nebi), quality(ebi))
-
+        return (quality(abi, self.__empty_volume), quality(nebi),
+                quality(ebi, self.__empty_volume))
@@ -1,4 +1,8 @@
+import hashlib
 import numpy as np
+import os
+import threading
+import zipfile
 import zlib
 import pickle
 import yaml
@@ -6,12 +10,23 @@ import yaml
 from enum import Enum
 
 from scipy.interpolate import Rbf
-from scipy.interpolate import LinearNDInterpolator
 
 from .binning import BinningExtender
+from .binning import Binning_Types
+from .binning import Pad_Modes
 from .histogram import HistogramExtender
+from .histogram import Pad_Values
+from .histogram import SparseHistogram
 
+from .helper import LRUCache
+from .helper import SafeLoader
+from .helper import arrays_digest
+from .helper import atomic_write
 from .helper import to_dict
+from .interpolators import GridLinearInterpolator
+from .interpolators import LocalRbfInterpolator
+from .interpolators import MultilinearInterpolator
+from .interpolators import SparseMultilinearInterpolator
 
 from .binning import Binning
 
@@ -20,6 +35,9 @@ class Interpolation_Modes(Enum):
     LINEAR = 1
     RBF_LINEAR = 2
     RBF_MULTIQUAD = 3
+    MULTILINEAR = 4
+    RBF_LINEAR_LOCAL = 5
+    RBF_MULTIQUAD_LOCAL = 6
 
 
 class ModelParams():
@@ -49,22 +67,140 @@ class ModelParams():
         return ModelParams(**d)
 
 
+class EvaluationCache():
+    """Memoizes evaluations of model functions over tensor grids. At most
+       capacity grids are kept in memory, least recently used first out.
+       If a directory is given, evaluations are also stored there as npy
+       files, keyed by the content hashes of the model and the grid, so
+       they are reused across runs."""
+
+    def __init__(self, capacity=8, directory=None):
+        self.__memory = LRUCache(capacity)
+        self.__directory = directory
+        self.__disk_hits = 0
+        self.__lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def directory(self):
+        return self.__directory
+
+    @property
+    def hits(self):
+        """Evaluations served from memory or disk."""
+        return self.__memory.hits + self.__disk_hits
+
+    @property
+    def misses(self):
+        """Evaluations computed by interpolation."""
+        return self.__memory.misses - self.__disk_hits
+
+    @property
+    def disk_hits(self):
+        return self.__disk_hits
+
+    def get(self, model_digest, grid_digest, evaluate):
+        """Returns the cached values for the model and grid, calling
+           evaluate() on a miss. Returned arrays are read-only."""
+        def create():
+            if self.directory is None:
+                values = evaluate()
+            else:
+                values = self.__from_disk(model_digest, grid_digest, evaluate)
+            values.setflags(write=False)
+            return values
+        return self.__memory.get((model_digest, grid_digest), create)
+
+    def __from_disk(self, model_digest, grid_digest, evaluate):
+        filename = os.path.join(self.directory, "%s.npy" % hashlib.sha256(
+            ("%s:%s" % (model_digest, grid_digest)).encode()).hexdigest())
+        if os.path.isfile(filename):
+            with self.__lock:
+                self.__disk_hits += 1
+            return np.load(filename)
+
+        values = evaluate()
+        with atomic_write(filename) as tmpname:
+            np.save(tmpname, values)
+        return values
+
+
 class Model():
-    def __init__(self, binning, model_params, function, column_names):
+    """The model function F is interpolated over the extended grid values,
+       i.e. the normalized histogram padded according to the model params.
+       When the grid values are known, F is only built on first access."""
+
+    def __init__(self, binning, model_params, function, column_names,
+                 values=None):
         self.__binning = binning.copy()
         self.__model_params = model_params
         self.__function = function
         self.__column_names = column_names
+        self.__values = values
+        self.__digest = None
+        self.__cache = None
 
     @staticmethod
     def from_file(filename):
+        """Loads a model saved with to_file, in either format."""
+        if zipfile.is_zipfile(filename):
+            return Model.__from_npz(filename)
         with open(filename, "r") as f:
-            mobj = yaml.load(f)
+            mobj = yaml.load(f, Loader=SafeLoader)
         return Model.from_dict(mobj)
 
-    def to_file(self, filename):
-        with open(filename, "w") as f:
-            yaml.dump(self.to_dict(), f)
+    def to_file(self, filename, binary=False):
+        """Saves the model as yaml, with F pickled, or if binary is set, as
+           an uncompressed npz file holding the binning, model params,
+           column names and extended grid values, from which F is rebuilt
+           when it is needed."""
+        if binary:
+            self.__to_npz(filename)
+        else:
+            with open(filename, "w") as f:
+                yaml.dump(self.to_dict(), f)
+
+    def __to_npz(self, filename):
+        if self.__values is None:
+            raise Exception("Model has no grid values to save.")
+        arrays = {
+            "binning_type": np.array(self.binning.type.value),
+            "random_seed": np.array(self.binning.random_seed),
+            "column_names": np.array(self.column_names),
+            "pad_mode": np.array(self.model_params.pad_mode.value),
+            "pad_value": np.array(self.model_params.pad_value.value),
+            "interpolation_mode": np.array(
+                self.model_params.interpolation_mode.value)
+        }
+        if isinstance(self.__values, SparseHistogram):
+            arrays["bin_indices"] = self.__values.bin_indices
+            arrays["values"] = self.__values.values
+            arrays["border_value"] = np.array(self.__values.border_value)
+        else:
+            arrays["values"] = self.__values
+        for dim, edges_along_dim in enumerate(self.binning.edges):
+            arrays["edges_%d" % dim] = edges_along_dim
+        with open(filename, "wb") as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def __from_npz(filename):
+        with np.load(filename) as f:
+            column_names = f["column_names"].tolist()
+            edges = [f["edges_%d" % dim] for dim in range(len(column_names))]
+            binning = Binning(Binning_Types(int(f["binning_type"])), edges,
+                              int(f["random_seed"]))
+            model_params = ModelParams(
+                Pad_Modes(int(f["pad_mode"])),
+                Pad_Values(int(f["pad_value"])),
+                Interpolation_Modes(int(f["interpolation_mode"])))
+            values = f["values"]
+            if "bin_indices" in f.files:
+                values = SparseHistogram(
+                    BinningExtender.extend(binning, model_params.pad_mode),
+                    f["bin_indices"], values, float(f["border_value"]))
+        return Model(binning, model_params, None, column_names, values)
 
     @staticmethod
     def from_dict(mobj):
@@ -83,14 +219,37 @@ class Model():
             model_params.pad_mode,
             model_params.pad_value)
 
-        extended_binning = extended_histogram.binning
-        extended_values = extended_histogram.values
+        if not isinstance(model_params.interpolation_mode,
+                          Interpolation_Modes):
+            raise Exception("Invalid interpolation_mode.")
+
+        if isinstance(extended_histogram, SparseHistogram):
+            if (model_params.interpolation_mode !=
+                    Interpolation_Modes.MULTILINEAR):
+                raise Exception("Sparse histograms are only supported by "
+                                "the multilinear interpolation_mode.")
+            # the grid values stay sparse
+            extended_values = extended_histogram
+        else:
+            extended_values = extended_histogram.values
+
+        if not column_names:
+            column_names = ["Resource%s" % i
+                            for i in range(histogram.binning.dimensions)]
+
+        return Model(histogram.binning, model_params, None, column_names,
+                     extended_values)
+
+    @staticmethod
+    def __interpolate(model_params, binning, values):
+        extended_binning = BinningExtender.extend(binning,
+                                                  model_params.pad_mode)
+        extended_values = values
 
         interpolation_mode = model_params.interpolation_mode
         if (interpolation_mode == Interpolation_Modes.LINEAR):
-            function = LinearNDInterpolator(
-                np.stack([x.flatten() for x in extended_binning.meshgrids],
-                         axis=-1), extended_values.flatten())
+            function = GridLinearInterpolator(extended_binning.centers,
+                                              extended_values)
         elif (interpolation_mode == Interpolation_Modes.RBF_LINEAR):
             function = Rbf(*extended_binning.meshgrids,
                                   extended_values.flatten(), smooth=0.0,
@@ -99,14 +258,25 @@ class Model():
             function = Rbf(*extended_binning.meshgrids,
                                   extended_values.flatten(), smooth=0.0,
                                   function="multiquadric")
+        elif (interpolation_mode == Interpolation_Modes.MULTILINEAR):
+            if isinstance(extended_values, SparseHistogram):
+                function = SparseMultilinearInterpolator(extended_values)
+            else:
+                function = MultilinearInterpolator(extended_binning.centers,
+                                                   extended_values)
+        elif (interpolation_mode == Interpolation_Modes.RBF_LINEAR_LOCAL):
+            function = LocalRbfInterpolator(
+                np.stack([x.flatten() for x in extended_binning.meshgrids],
+                         axis=-1), extended_values.flatten(),
+                kernel="linear")
+        elif (interpolation_mode == Interpolation_Modes.RBF_MULTIQUAD_LOCAL):
+            function = LocalRbfInterpolator(
+                np.stack([x.flatten() for x in extended_binning.meshgrids],
+                         axis=-1), extended_values.flatten(),
+                kernel="multiquadric")
         else:
             raise Exception("Invalid interpolation_mode.")
-
-        if not column_names:
-            column_names = ["Resource%s" % i
-                            for i in range(histogram.binning.dimensions)]
-
-        return Model(histogram.binning, model_params, function, column_names)
+        return function
 
 
     def to_dict(self):
@@ -114,7 +284,7 @@ class Model():
             "binning": self.binning.to_dict(),
             "column_names": self.column_names,
             "model_params": self.model_params.to_dict(),
-            "function": zlib.compress(pickle.dumps(self.__function))
+            "function": zlib.compress(pickle.dumps(self.F))
         }
         return mobj
 
@@ -124,8 +294,124 @@ class Model():
 
     @property
     def F(self):
+        if self.__function is None:
+            self.__function = Model.__interpolate(
+                self.model_params, self.binning, self.__values)
         return self.__function
 
+    def evaluate(self, binning):
+        """Returns F at the centers of all bins of binning, with shape
+           binning.counts."""
+        return self.evaluate_grid(binning.centers)
+
+    def evaluate_grid(self, axes):
+        """Returns F over the tensor grid with the given coordinates along
+           each dimension, with shape [len(axis) for axis in axes].
+           Evaluations are memoized per grid if the model has a cache."""
+        def evaluate():
+            return self.F(*np.meshgrid(*axes, indexing='ij'))
+        if self.cache is None:
+            return evaluate()
+        return self.cache.get(self.digest, arrays_digest(axes), evaluate)
+
+    def evaluate_chunks(self, axes, chunk_size=2**20):
+        """Walks the tensor grid with the given coordinates along each
+           dimension in C order, chunk_size points at a time, without
+           building the full grid. Yields (indices, values): the grid
+           indices of the points along each dimension, and F at them."""
+        shape = [len(axis) for axis in axes]
+        size = int(np.prod(shape))
+        for first in range(0, size, chunk_size):
+            indices = np.unravel_index(
+                np.arange(first, min(first + chunk_size, size)), shape)
+            yield indices, self.F(*[axis[idx]
+                                    for axis, idx in zip(axes, indices)])
+
+    def evaluate_into(self, axes, out=None, chunk_size=2**20):
+        """Writes F over the tensor grid into out, chunk_size points at a
+           time, and returns it. out is allocated if not given, and may be
+           a numpy.memmap, e.g. from numpy.lib.format.open_memmap."""
+        shape = tuple(len(axis) for axis in axes)
+        if out is None:
+            out = np.empty(shape)
+        elif out.shape != shape or not out.flags.c_contiguous:
+            raise Exception("out must be a C-contiguous array of shape %s."
+                            % (shape,))
+        flat = out.reshape(-1)
+        first = 0
+        for _, values in self.evaluate_chunks(axes, chunk_size):
+            flat[first:first + values.shape[0]] = values
+            first += values.shape[0]
+        return out
+
+    def projections(self, axes, dims, chunk_size=2**20):
+        """Returns, for each tuple of dimensions in dims, the sums of F over
+           the tensor grid along all other dimensions, computed in a single
+           chunked pass. E.g. dims=[(0, 1), (2,), ()] yields a 2-D
+           projection, a 1-D projection and the total sum. Results are
+           memoized like those of evaluate_grid."""
+        dims = [tuple(kept) for kept in dims]
+        shapes = [[len(axes[dim]) for dim in kept] for kept in dims]
+        sizes = [int(np.prod(shape)) for shape in shapes]
+
+        def evaluate():
+            sums = np.zeros(sum(sizes))
+            offsets = np.cumsum([0] + sizes[:-1])
+            for indices, values in self.evaluate_chunks(axes, chunk_size):
+                for kept, shape, offset, size in zip(dims, shapes, offsets,
+                                                     sizes):
+                    if kept:
+                        idx = np.ravel_multi_index(
+                            [indices[dim] for dim in kept], shape)
+                    else:
+                        idx = np.zeros(values.shape[0], dtype=np.intp)
+                    sums[offset:offset + size] += np.bincount(
+                        idx, weights=values, minlength=size)
+            return sums
+
+        if self.cache is None:
+            sums = evaluate()
+        else:
+            sums = self.cache.get(self.digest, "%s:%s" % (
+                arrays_digest(axes), dims), evaluate)
+        return [total.reshape(shape) for total, shape in
+                zip(np.split(sums, np.cumsum(sizes[:-1])), shapes)]
+
+    @property
+    def cache(self):
+        """The EvaluationCache used by evaluate, None by default."""
+        return self.__cache
+
+    @cache.setter
+    def cache(self, cache):
+        self.__cache = cache
+
+    @property
+    def digest(self):
+        """Content hash of the model: binning, params and grid values, or
+           the pickled F if the grid values are not known."""
+        if self.__digest is None:
+            h = hashlib.sha256(self.binning.digest.encode())
+            h.update(str([self.model_params.pad_mode,
+                          self.model_params.pad_value,
+                          self.model_params.interpolation_mode]).encode())
+            if isinstance(self.__values, SparseHistogram):
+                h.update(arrays_digest([
+                    self.__values.bin_indices, self.__values.values,
+                    [self.__values.border_value]]).encode())
+            elif self.__values is not None:
+                h.update(arrays_digest([self.__values.ravel()]).encode())
+            else:
+                h.update(pickle.dumps(self.F))
+            self.__digest = h.hexdigest()
+        return self.__digest
+
+    @property
+    def values(self):
+        """The extended grid values F interpolates, if known: an array, or
+           a SparseHistogram for models of sparse histograms."""
+        return self.__values
+
     @property
     def model_params(self):
         return self.__model_params
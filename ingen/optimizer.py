@@ -0,0 +1,175 @@
+import itertools
+import numpy as np
+
+from multiprocessing import Pool
+
+from .binning import Binning
+from .binning import BinningGenerator
+from .binning import Binning_Types
+from .binning import ClusteredBinning
+from .binning import QuantileBinning
+from .bundles import BundleGenerator
+from .kpis import KPIs
+from .model import Model
+from .sketches import QuantileSketch
+
+
+class BinningOptimizer():
+    """Searches the number of bins along each dimension of a binning of a
+       datasource: the finest binning whose bundles fit in a budget.
+
+       A binning fits if the amount of bundles recommended by its bundle
+       generator is at most the budget: the amount reaching an expected best
+       quality of 1, or target_quality if given. Starting from a coarse
+       binning, the search repeatedly refines the dimension whose refined
+       binning fits and gives bundles of the best quality (KPIs.quality of
+       budget-capped bundles generated in memory), until no refinement fits.
+
+       Work is reused across neighbouring candidates, which differ in one
+       dimension only: the edges along each dimension are computed once per
+       count, the clustering inputs and quantile sketches once per search,
+       and each distinct binning is scored once. The candidates of a step
+       are scored in a pool of worker processes."""
+
+    def __init__(self, datasource, type, budget, model_params,
+                 target_quality=None, column_names=None, spread=0.3,
+                 prehistogram=None, random_seed=0):
+        """datasource: a DataSource, histogrammed once per candidate.
+           type: Binning_Types of the binnings searched.
+           model_params: ModelParams of the models derived per candidate.
+           random_seed: seed of the bundles generated per candidate."""
+        self.__datasource = datasource
+        self.__type = type
+        self.__budget = budget
+        self.__model_params = model_params
+        self.__target_quality = target_quality
+        self.__column_names = column_names
+        self.__spread = spread
+        self.__random_seed = random_seed
+        self.__edges = {}
+        self.__scores = {}
+        self.__history = []
+
+        if type == Binning_Types.CLUSTERED:
+            self.__columns = ClusteredBinning.weighted_values(datasource,
+                                                              prehistogram)
+        elif type == Binning_Types.QUANTILE:
+            self.__sketches = QuantileSketch.sketch_datasource(
+                datasource, random_seed=random_seed)
+
+    @property
+    def budget(self):
+        return self.__budget
+
+    @property
+    def history(self):
+        """Scores of all candidates, in the order they were evaluated."""
+        return self.__history
+
+    def binning(self, counts):
+        """Returns the binning with counts bins along each dimension; fewer
+           if some of its edges coincide, as for discrete data."""
+        return Binning(self.__type, [self.__dim_edges(dim, count)
+                                     for dim, count in enumerate(counts)])
+
+    def __dim_edges(self, dim, count):
+        key = (dim, count)
+        if key not in self.__edges:
+            domain = self.__datasource.domain[dim]
+            if self.__type == Binning_Types.CLUSTERED:
+                edges = ClusteredBinning.cluster_edges(
+                    count, domain, *self.__columns[dim])
+            elif self.__type == Binning_Types.QUANTILE:
+                edges = QuantileBinning.quantile_edges(
+                    count, domain, self.__sketches[dim])
+            else:
+                edges = BinningGenerator.generate(
+                    self.__type, [count], [domain],
+                    spread=self.__spread).edges[0]
+            self.__edges[key] = edges
+        return self.__edges[key]
+
+    def score(self, candidates, workers=1):
+        """Returns the score of the binning with each of the candidate
+           counts, as a dict of: counts, the number of bins, whether it
+           fits, the recommended amount (None if target_quality can not be
+           reached), the amount generated (at most the budget), its expected
+           best quality, and the quality and error of the bundles."""
+        binnings = [self.binning(counts) for counts in candidates]
+        pending = {}
+        for binning in binnings:
+            if binning.digest in self.__scores or binning.digest in pending:
+                continue
+            histogram = self.__datasource.get_histogram(binning)
+            pending[binning.digest] = (
+                histogram, binning, self.__model_params, self.__budget,
+                self.__target_quality, self.__column_names,
+                self.__random_seed)
+
+        if workers > 1 and len(pending) > 1:
+            with Pool(min(workers, len(pending))) as pool:
+                results = pool.starmap(_score, pending.values())
+        else:
+            results = list(itertools.starmap(_score, pending.values()))
+        for digest, result in zip(pending, results):
+            self.__scores[digest] = result
+
+        scores = []
+        for counts, binning in zip(candidates, binnings):
+            score = dict(self.__scores[binning.digest])
+            score["counts"] = list(counts)
+            self.__history.append(score)
+            scores.append(score)
+        return scores
+
+    def search(self, start=2, max_count=64, workers=1):
+        """Returns the binning found and its score. start and max_count
+           bound the number of bins along each dimension; each step grows
+           one dimension by a quarter of its count, at least by one."""
+        counts = [start] * len(self.__datasource.domain)
+        best = self.score([counts], workers)[0]
+        if not best["fits"]:
+            return self.binning(counts), best
+
+        while True:
+            candidates = []
+            for dim, count in enumerate(counts):
+                if count < max_count:
+                    grown = list(counts)
+                    grown[dim] = min(count + max(1, count // 4), max_count)
+                    candidates.append(grown)
+            better = [score for score in self.score(candidates, workers)
+                      if score["fits"] and score["bins"] > best["bins"]]
+            if not better:
+                return self.binning(counts), best
+            best = max(better, key=lambda score: (score["quality"],
+                                                  -score["amount"]))
+            counts = best["counts"]
+
+
+def _score(histogram, binning, model_params, budget, target_quality,
+           column_names, random_seed):
+    # scores the model of histogram by the bundles generated for binning
+    normalized = histogram.copy()
+    normalized.normalize()
+    model = Model.from_histogram(model_params, normalized, column_names)
+    bg = BundleGenerator(model, binning)
+
+    try:
+        amount = bg.recommended_amount(histogram, target_quality)
+    except Exception:
+        # target_quality can not be reached with this binning
+        amount = None
+    generated = budget if amount is None else max(min(amount, budget), 1)
+    bundles = bg.generate_binned(generated, random_seed=random_seed)
+    kpis = KPIs(histogram, bundles.get_histogram(binning))
+    return {
+        "bins": int(np.prod(binning.counts)),
+        "fits": amount is not None and amount <= budget,
+        "amount": amount,
+        "generated": generated,
+        "expected_quality": float(bg.expected_best_quality(generated,
+                                                           histogram)),
+        "quality": float(kpis.quality()[0]),
+        "error": float(kpis.error())
+    }
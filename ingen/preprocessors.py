@@ -7,8 +7,12 @@ import json
 import yaml
 import glob
 
+from .binning import Binning
+from .helper import SafeLoader
 from .helper import objectview
 from .histogram import Histogram
+from .histogram import HistogramEngine
+from .histogram import SparseHistogram
 
 
 class DatasetProcessor():
@@ -269,22 +273,215 @@ class DataSource():
     def column_names(self):
         return self.__column_names
 
+    @property
+    def chunk_size(self):
+        """Number of rows per chunk yielded by iter_chunks by default."""
+        return 2**20
+
     def __call__(self):
         return self.data
 
-    def get_histogram(self, binning):
-        values, _ = np.histogramdd(
-            self.data, bins=binning.edges, normed=True)
-        return Histogram(binning, values)
+    def iter_chunks(self, chunk_size=None):
+        """Yields the datapoints in arrays of at most chunk_size rows."""
+        chunk_size = chunk_size or self.chunk_size
+        for first in range(0, self.data.shape[0], chunk_size):
+            yield self.data[first:first + chunk_size]
+
+    def get_histogram(self, binning, sparse=False):
+        """Returns the density histogram of the data in binning, as a
+           SparseHistogram if sparse is set."""
+        engine = HistogramEngine(binning, sparse=sparse)
+        engine.add(self.data)
+        return engine.histogram()
+
+    def to_binned(self, binning):
+        """Returns a BinnedDataSource with the number of datapoints in each
+           occupied bin of binning; datapoints outside binning are dropped.
+           Saving it keeps the assignment of datapoints to bins, so that the
+           datasource does not have to be binned again."""
+        engine = HistogramEngine.for_chunks(binning, self.chunk_size,
+                                            sparse=True)
+        for chunk in self.iter_chunks():
+            engine.add(chunk)
+        bin_indices, counts = engine.counts
+        return BinnedDataSource(self.info, self.domain, self.column_names,
+                                binning, bin_indices, counts)
+
+
+class FileDataSource(DataSource):
+    """A datasource whose datapoints stay in its data file until needed.
+       It is histogrammed by reading the file in chunks, so memory use does
+       not depend on the size of the datasource."""
+
+    def __init__(self, info, domain, column_names, datafile,
+                 chunk_size=2**18):
+        super().__init__(info, domain, column_names, None)
+        self.__datafile = datafile
+        self.__chunk_size = chunk_size
+        self.__data = None
+
+    @property
+    def datafile(self):
+        return self.__datafile
+
+    @property
+    def chunk_size(self):
+        return self.__chunk_size
+
+    @property
+    def data(self):
+        """All datapoints, read from the data file on first access and kept
+           in memory. Prefer iter_chunks for large datasources."""
+        if self.__data is None:
+            self.__data = np.loadtxt(self.datafile, delimiter=",")
+        return self.__data
+
+    def iter_chunks(self, chunk_size=None):
+        """Yields the datapoints in arrays of at most chunk_size rows, with
+           the same values np.loadtxt would read."""
+        reader = pd.read_csv(self.datafile, header=None, dtype=float,
+                             float_precision="round_trip",
+                             chunksize=chunk_size or self.chunk_size)
+        with reader:
+            for chunk in reader:
+                yield chunk.to_numpy()
+
+    def get_histogram(self, binning, sparse=False):
+        engine = HistogramEngine.for_chunks(binning, self.chunk_size,
+                                            sparse=sparse)
+        for chunk in self.iter_chunks():
+            engine.add(chunk)
+        return engine.histogram()
+
+
+class BinnedDataSource(DataSource):
+    """A datasource whose datapoints all lie on bin centers, stored as the
+       number of datapoints (counts) in each bin (bin_indices, flat indices
+       into binning). It is histogrammed without expanding the datapoints."""
+
+    def __init__(self, info, domain, column_names, binning, bin_indices,
+                 counts):
+        super().__init__(info, domain, column_names, None)
+        self.__binning = binning
+        self.__bin_indices = bin_indices
+        self.__counts = counts
+
+    @property
+    def binning(self):
+        return self.__binning
+
+    @property
+    def bin_indices(self):
+        return self.__bin_indices
+
+    @property
+    def counts(self):
+        return self.__counts
+
+    @property
+    def data(self):
+        """All datapoints, one row per datapoint. Prefer iter_chunks for
+           large datasources."""
+        return np.repeat(self.binning.bin_centers(self.bin_indices),
+                         self.counts, axis=0)
+
+    def iter_chunks(self, chunk_size=None):
+        """Yields the datapoints in arrays of at most chunk_size rows."""
+        chunk_size = chunk_size or self.chunk_size
+        centers = self.binning.bin_centers(self.bin_indices)
+        ends = np.cumsum(self.counts)
+        for first in range(0, int(ends[-1]) if ends.size else 0, chunk_size):
+            rows = np.arange(first, min(first + chunk_size, ends[-1]))
+            yield centers[np.searchsorted(ends, rows, side='right')]
+
+    def get_histogram(self, binning, sparse=False):
+        if binning.digest != self.binning.digest:
+            # each bin center stands for counts datapoints
+            engine = HistogramEngine(binning, sparse=sparse)
+            engine.add(self.binning.bin_centers(self.bin_indices),
+                       weights=self.counts)
+            return engine.histogram()
+
+        # the counts are already known, no need to bin the data
+        if sparse:
+            occupied = self.counts > 0
+            return SparseHistogram(binning, self.bin_indices[occupied],
+                                   HistogramEngine.sparse_density(
+                                       binning, self.bin_indices[occupied],
+                                       self.counts[occupied]))
+        counts = np.zeros(int(np.prod(binning.counts)), dtype=np.int64)
+        counts[self.bin_indices] = self.counts
+        return Histogram(binning, HistogramEngine.density(binning, counts))
+
+    def to_binned(self, binning):
+        if binning.digest == self.binning.digest:
+            return self
+        engine = HistogramEngine(binning, sparse=True)
+        engine.add(self.binning.bin_centers(self.bin_indices),
+                   weights=self.counts)
+        bin_indices, counts = engine.counts
+        return BinnedDataSource(self.info, self.domain, self.column_names,
+                                binning, bin_indices, counts)
+
+
+class DataSourceStream():
+    """A datasource whose data is produced lazily, as a sequence of arrays
+       with one row per datapoint. It can be iterated only once."""
+
+    def __init__(self, info, domain, column_names, chunks):
+        self.__info = info
+        self.__domain = domain
+        self.__column_names = column_names
+        self.__chunks = chunks
+
+    @property
+    def info(self):
+        return self.__info
+
+    @property
+    def domain(self):
+        return self.__domain
+
+    @property
+    def column_names(self):
+        return self.__column_names
+
+    def __iter__(self):
+        return iter(self.__chunks)
 
 
 class DataSourceIO():
     @staticmethod
-    def read(filename):
+    def read(filename, lazy=False):
+        """Reads the datasource saved as filename. If lazy is set, the
+           datapoints are not loaded: a FileDataSource is returned, which
+           reads them in chunks when needed."""
         datafile = "%s.csv" % filename
         metafile = "%s.yaml" % filename
         with open(metafile, "r") as mf:
-            mobj = yaml.load(mf)
+            mobj = yaml.load(mf, Loader=SafeLoader)
+
+        if "binning" in mobj["dataset"]:
+            table = np.loadtxt("%s.bins.csv" % filename, delimiter=",",
+                               dtype=np.int64, ndmin=2)
+            return BinnedDataSource(
+                info=objectview(mobj["source_info"]),
+                domain=mobj["dataset"]["domain"],
+                column_names=mobj["dataset"]["column_names"],
+                binning=Binning.from_dict(mobj["dataset"]["binning"]),
+                bin_indices=table[:, 0],
+                counts=table[:, 1]
+            )
+
+        if lazy:
+            if not os.path.isfile(datafile):
+                raise Exception("Data file %s does not exist." % datafile)
+            return FileDataSource(
+                info=objectview(mobj["source_info"]),
+                domain=mobj["dataset"]["domain"],
+                column_names=mobj["dataset"]["column_names"],
+                datafile=datafile
+            )
 
         data = np.loadtxt(datafile, delimiter=",")
 
@@ -302,8 +499,32 @@ class DataSourceIO():
         datafile = "%s.csv" % filename
         metafile = "%s.yaml" % filename
 
-        np.savetxt(datafile, datasource.data, delimiter=",")
+        if isinstance(datasource, BinnedDataSource):
+            # (bin index, count) rows instead of one row per datapoint
+            np.savetxt("%s.bins.csv" % filename,
+                       np.column_stack((datasource.bin_indices,
+                                        datasource.counts)),
+                       fmt="%d", delimiter=",")
+        else:
+            np.savetxt(datafile, datasource.data, delimiter=",")
+
+        DataSourceIO.__write_metadata(datasource, metafile)
+
+    @staticmethod
+    def write_stream(stream, filename):
+        """Writes a DataSourceStream chunk by chunk, appending each chunk
+           to the data file, so only one chunk is held in memory."""
+        datafile = "%s.csv" % filename
+        metafile = "%s.yaml" % filename
+
+        with open(datafile, "w") as f:
+            for chunk in stream:
+                np.savetxt(f, chunk, delimiter=",")
+
+        DataSourceIO.__write_metadata(stream, metafile)
 
+    @staticmethod
+    def __write_metadata(datasource, metafile):
         mobj = {
             "source_info": datasource.info.__dict__,
             "dataset": {
@@ -311,6 +532,8 @@ class DataSourceIO():
                 "column_names": datasource.column_names
             }
         }
+        if isinstance(datasource, BinnedDataSource):
+            mobj["dataset"]["binning"] = datasource.binning.to_dict()
 
         # with open(filename_goes_here, "w") as f:
         #    json.dump(mobj, f, indent=4)
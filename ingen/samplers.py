@@ -0,0 +1,262 @@
+import numpy as np
+
+from enum import Enum
+
+
+class Sampling_Modes(Enum):
+    ALIAS = 1
+    CDF = 2
+    UNIFORM = 3
+    STRATIFIED = 4
+
+
+class Sampler():
+    """Draws indices of a discrete distribution over a fixed number of
+       outcomes. The distribution is preprocessed once, at construction."""
+
+    def __init__(self, size):
+        self.__size = size
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def mode(self):
+        raise NotImplementedError()
+
+    @property
+    def tables(self):
+        """The preprocessed distribution, as a dict of arrays."""
+        raise NotImplementedError()
+
+    def sample(self, amount, rng):
+        """Returns an array of amount indices drawn with the
+           numpy.random.Generator rng.
+
+           Each index is derived from exactly one rng.random() value, so
+           drawing in several calls yields the same indices as one call."""
+        raise NotImplementedError()
+
+    def allocate(self, amount, rng, chunk_size=2**20):
+        """Returns how many of amount draws fall on each outcome. The draws
+           are the ones sample would return, made chunk_size at a time."""
+        counts = np.zeros(self.size, dtype=np.int64)
+        for first in range(0, amount, chunk_size):
+            counts += np.bincount(
+                self.sample(min(chunk_size, amount - first), rng),
+                minlength=self.size)
+        return counts
+
+    def stream(self, amount, rng, chunk_size=2**20):
+        """Yields the indices sample would return for amount draws, in
+           arrays of at most chunk_size indices."""
+        for first in range(0, amount, chunk_size):
+            yield self.sample(min(chunk_size, amount - first), rng)
+
+    def _columns(self, uniforms):
+        # maps uniforms in [0, 1) to a column index and its fractional part
+        x = uniforms * self.size
+        columns = np.minimum(x.astype(np.intp), self.size - 1)
+        return columns, x - columns
+
+    @staticmethod
+    def build(mode, weights):
+        if mode == Sampling_Modes.ALIAS:
+            return AliasSampler(weights)
+        elif mode == Sampling_Modes.CDF:
+            return CDFSampler(weights)
+        elif mode == Sampling_Modes.UNIFORM:
+            return UniformSampler(len(weights))
+        elif mode == Sampling_Modes.STRATIFIED:
+            return StratifiedSampler(weights)
+        else:
+            raise Exception("Invalid sampling_mode.")
+
+    @staticmethod
+    def from_tables(mode, tables):
+        """Rebuilds a sampler from its tables without preprocessing."""
+        if mode == Sampling_Modes.ALIAS:
+            return AliasSampler.from_tables(tables)
+        elif mode == Sampling_Modes.CDF:
+            return CDFSampler.from_tables(tables)
+        elif mode == Sampling_Modes.UNIFORM:
+            return UniformSampler(int(tables["size"]))
+        elif mode == Sampling_Modes.STRATIFIED:
+            return StratifiedSampler(tables["weights"])
+        else:
+            raise Exception("Invalid sampling_mode.")
+
+
+class AliasSampler(Sampler):
+    """Walker's alias method with Vose's construction: O(n) setup,
+       O(1) per draw."""
+
+    def __init__(self, weights):
+        super().__init__(len(weights))
+        self.__threshold, self.__alias = self.__build_table(
+            np.asarray(weights, dtype=float))
+
+    @property
+    def threshold(self):
+        return self.__threshold
+
+    @property
+    def alias(self):
+        return self.__alias
+
+    @property
+    def mode(self):
+        return Sampling_Modes.ALIAS
+
+    @property
+    def tables(self):
+        return {"threshold": self.threshold, "alias": self.alias}
+
+    @staticmethod
+    def from_tables(tables):
+        sampler = AliasSampler.__new__(AliasSampler)
+        Sampler.__init__(sampler, len(tables["alias"]))
+        sampler.__threshold = tables["threshold"]
+        sampler.__alias = tables["alias"]
+        return sampler
+
+    def sample(self, amount, rng):
+        columns, coins = self._columns(rng.random(amount))
+        return np.where(coins < self.threshold[columns],
+                        columns, self.alias[columns])
+
+    @staticmethod
+    def __build_table(weights):
+        n = weights.shape[0]
+        q = weights * n / weights.sum()
+        threshold = np.ones(n)
+        alias = np.arange(n)
+
+        small = np.flatnonzero(q < 1.0)
+        large = np.flatnonzero(q >= 1.0)
+        # Vose's algorithm, processing all small columns in one round:
+        # the deficits (1 - q) of the small columns are laid out one after
+        # another and each one is topped up by the large column whose excess
+        # (q - 1) covers the start of the deficit. Large columns that give
+        # away more than their excess become small in the next round.
+        while small.size and large.size:
+            deficits = 1.0 - q[small]
+            starts = np.cumsum(deficits) - deficits
+            donors = np.searchsorted(np.cumsum(q[large] - 1.0), starts,
+                                     side='right')
+            donors = large[np.minimum(donors, large.size - 1)]
+
+            threshold[small] = q[small]
+            alias[small] = donors
+            q[large] -= np.bincount(donors, weights=deficits,
+                                    minlength=n)[large]
+
+            small = large[q[large] < 1.0]
+            large = large[q[large] >= 1.0]
+
+        # leftovers are only due to rounding errors
+        threshold[small] = 1.0
+        alias[small] = small
+        return threshold, alias
+
+
+class CDFSampler(Sampler):
+    """Inverse transform sampling on the cumulative distribution:
+       O(n) setup, O(log n) per draw."""
+
+    def __init__(self, weights):
+        super().__init__(len(weights))
+        self.__cdf = np.cumsum(weights, dtype=float)
+        self.__cdf /= self.__cdf[-1]
+
+    @property
+    def cdf(self):
+        return self.__cdf
+
+    @property
+    def mode(self):
+        return Sampling_Modes.CDF
+
+    @property
+    def tables(self):
+        return {"cdf": self.cdf}
+
+    @staticmethod
+    def from_tables(tables):
+        sampler = CDFSampler.__new__(CDFSampler)
+        Sampler.__init__(sampler, len(tables["cdf"]))
+        sampler.__cdf = tables["cdf"]
+        return sampler
+
+    def sample(self, amount, rng):
+        indices = np.searchsorted(self.cdf, rng.random(amount), side='right')
+        return np.minimum(indices, self.size - 1)
+
+
+class UniformSampler(Sampler):
+    """Draws all outcomes with equal probability."""
+
+    @property
+    def mode(self):
+        return Sampling_Modes.UNIFORM
+
+    @property
+    def tables(self):
+        return {"size": np.array(self.size)}
+
+    def sample(self, amount, rng):
+        columns, _ = self._columns(rng.random(amount))
+        return columns
+
+
+class StratifiedSampler(Sampler):
+    """Allocates amount * p draws to each outcome instead of drawing them
+       independently, in O(n) regardless of the amount. The fractional
+       parts are rounded by systematic sampling, so each outcome gets
+       either the floor or the ceiling of amount * p, and amount * p on
+       average. Indices are returned grouped by outcome, and draws split
+       over several calls are stratified per call; stream stratifies all
+       of its draws at once, whatever the chunk size."""
+
+    def __init__(self, weights):
+        super().__init__(len(weights))
+        self.__weights = np.asarray(weights, dtype=float) / np.sum(weights)
+
+    @property
+    def weights(self):
+        return self.__weights
+
+    @property
+    def mode(self):
+        return Sampling_Modes.STRATIFIED
+
+    @property
+    def tables(self):
+        return {"weights": self.weights}
+
+    def sample(self, amount, rng):
+        return np.repeat(np.arange(self.size), self.allocate(amount, rng))
+
+    def stream(self, amount, rng, chunk_size=2**20):
+        # allocate all draws at once, then expand the allocation one chunk
+        # at a time
+        ends = np.cumsum(self.allocate(amount, rng))
+        for first in range(0, amount, chunk_size):
+            yield np.searchsorted(ends, np.arange(
+                first, min(first + chunk_size, amount)), side='right')
+
+    def allocate(self, amount, rng, chunk_size=None):
+        expected = self.weights * amount
+        counts = np.floor(expected).astype(np.int64)
+        residual = amount - int(counts.sum())
+        if residual > 0:
+            # the fractional parts add up to residual; pick residual
+            # outcomes with one random offset and unit steps along them
+            fractions = np.cumsum(expected - counts)
+            fractions *= residual / fractions[-1]
+            picks = np.searchsorted(fractions,
+                                    rng.random() + np.arange(residual),
+                                    side='right')
+            counts[np.minimum(picks, self.size - 1)] += 1
+        return counts
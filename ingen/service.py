@@ -0,0 +1,156 @@
+import json
+import os
+import socketserver
+import numpy as np
+import yaml
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+from .binning import Binning
+from .bundles import BundleGenerator
+from .helper import LRUCache
+from .helper import SafeLoader
+from .model import Model
+from .samplers import Sampling_Modes
+
+
+class BundleService():
+    """Keeps models and bundle generators loaded between requests.
+       Files are identified by path, size and modification time, so an
+       updated file is loaded again."""
+
+    def __init__(self, cache_size=8):
+        self.__models = LRUCache(cache_size)
+        self.__binnings = LRUCache(cache_size)
+        self.__generators = LRUCache(cache_size)
+
+    @staticmethod
+    def __file_key(filename):
+        stat = os.stat(filename)
+        return (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+    def model(self, filename):
+        return self.__models.get(self.__file_key(filename),
+                                 lambda: Model.from_file(filename))
+
+    def binning(self, filename):
+        def load():
+            with open(filename, "r") as f:
+                return Binning.from_dict(yaml.load(f, Loader=SafeLoader))
+        return self.__binnings.get(self.__file_key(filename), load)
+
+    def generator(self, model_filename, binning_filename,
+                  sampling_mode=Sampling_Modes.ALIAS):
+        binning = self.binning(binning_filename)
+        key = (self.__file_key(model_filename), binning.digest, sampling_mode)
+        return self.__generators.get(key, lambda: BundleGenerator(
+            self.model(model_filename), binning,
+            sampling_mode=sampling_mode))
+
+    def stats(self):
+        return {name: {"size": len(cache), "hits": cache.hits,
+                       "misses": cache.misses}
+                for name, cache in [("models", self.__models),
+                                    ("binnings", self.__binnings),
+                                    ("generators", self.__generators)]}
+
+
+class BundleRequestHandler(BaseHTTPRequestHandler):
+    """Answers
+         GET /bundles?model=PATH&binning=PATH&amount=N
+                     [&seed=S][&sampling=alias|cdf|stratified][&chunk_size=C]
+       with the generated bundles as CSV, in the datasource format, streamed
+       chunk by chunk. The random seed is returned in the X-Random-Seed
+       header; each request draws from its own random stream.
+         GET /stats
+       returns the cache statistics as JSON."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path == "/bundles":
+            self.__bundles(query)
+        elif url.path == "/stats":
+            self.__send(200, "application/json",
+                        json.dumps(self.server.service.stats()))
+        else:
+            self.__send(404, "text/plain", "Unknown path %s.\n" % url.path)
+
+    def __bundles(self, query):
+        try:
+            amount = int(query["amount"])
+            seed = int(query["seed"]) if "seed" in query else None
+            chunk_size = int(query.get("chunk_size", 2**16))
+            if amount < 0:
+                raise Exception("amount must be at least 0.")
+            if chunk_size < 1:
+                raise Exception("chunk_size must be at least 1.")
+            sampling_mode = Sampling_Modes[
+                query.get("sampling", "alias").upper()]
+            bg = self.server.service.generator(
+                query["model"], query["binning"], sampling_mode)
+        except KeyError as e:
+            return self.__send(400, "text/plain",
+                               "Missing or invalid parameter %s.\n" % e)
+        except Exception as e:
+            return self.__send(400, "text/plain", "%s\n" % e)
+
+        stream = bg.generate_stream(amount, chunk_size, random_seed=seed)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("X-Random-Seed", str(stream.info.random_seed))
+        self.end_headers()
+        for chunk in stream:
+            np.savetxt(self.wfile, chunk, delimiter=",")
+
+    def __send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def address_string(self):
+        # clients of a Unix socket have no address
+        return str(self.client_address[0]) if self.client_address else ""
+
+
+class _PooledServerMixIn():
+    """Handles each request in a bounded pool of worker threads."""
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.__process, request, client_address)
+
+    def __process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+
+class BundleHTTPServer(_PooledServerMixIn, HTTPServer):
+    def __init__(self, address, service, workers=4):
+        self.service = service
+        self.pool = ThreadPoolExecutor(workers)
+        super().__init__(address, BundleRequestHandler)
+
+
+class BundleUnixServer(_PooledServerMixIn, socketserver.UnixStreamServer):
+    def __init__(self, path, service, workers=4):
+        self.service = service
+        self.pool = ThreadPoolExecutor(workers)
+        super().__init__(path, BundleRequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
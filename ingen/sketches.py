@@ -0,0 +1,166 @@
+import os
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QuantileSketch():
+    """KLL sketch of the distribution of a stream of values, answering
+       quantile queries with a rank error of about 1.7 / k, in space
+       O(k) regardless of the number of values.
+
+       The values are kept in levels of compactors: each value at level h
+       stands for 2**h values of the stream. When a level exceeds its
+       capacity, it is sorted and every other value, starting at a random
+       offset, moves up one level. Sketches of parts of a stream can be
+       merged into the sketch of the whole stream, so they can be built in
+       parallel, or from several datasources."""
+
+    def __init__(self, k=200, random_seed=None):
+        self.__k = k
+        self.__levels = [np.zeros(0)]
+        self.__count = 0
+        self.__min = np.inf
+        self.__max = -np.inf
+        self.__rng = np.random.default_rng(random_seed)
+
+    @property
+    def k(self):
+        return self.__k
+
+    @property
+    def count(self):
+        """Number of values sketched so far."""
+        return self.__count
+
+    @property
+    def min(self):
+        return self.__min
+
+    @property
+    def max(self):
+        return self.__max
+
+    @property
+    def levels(self):
+        return self.__levels
+
+    def update(self, values):
+        """Adds the values of a 1-D array; NaN values are ignored."""
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if values.shape[0] == 0:
+            return self
+        self.__count += values.shape[0]
+        self.__min = min(self.__min, values.min())
+        self.__max = max(self.__max, values.max())
+        self.__levels[0] = np.concatenate((self.__levels[0], values))
+        self.__compress()
+        return self
+
+    def merge(self, other):
+        """Adds the values sketched by other."""
+        if other.k != self.k:
+            raise Exception("Sketches of different sizes can not be merged.")
+        self.__count += other.count
+        self.__min = min(self.__min, other.min)
+        self.__max = max(self.__max, other.max)
+        for h, items in enumerate(other.levels):
+            if h == len(self.__levels):
+                self.__levels.append(np.zeros(0))
+            self.__levels[h] = np.concatenate((self.__levels[h], items))
+        self.__compress()
+        return self
+
+    def quantiles(self, q):
+        """Returns the approximate q-quantiles of the values sketched, for
+           an array of q in [0, 1]."""
+        if self.count == 0:
+            raise Exception("Quantiles of an empty sketch.")
+        items = np.concatenate(self.__levels)
+        weights = np.concatenate([np.full(items_at_level.shape[0], 2.0 ** h)
+                                  for h, items_at_level
+                                  in enumerate(self.__levels)])
+        order = np.argsort(items, kind="stable")
+        ranks = np.cumsum(weights[order])
+        q = np.asarray(q, dtype=float)
+        idx = np.minimum(np.searchsorted(ranks, q * ranks[-1], side='left'),
+                         items.shape[0] - 1)
+        values = items[order][idx]
+        # the extremes are known exactly
+        values = np.where(q <= 0.0, self.min, values)
+        return np.where(q >= 1.0, self.max, values)
+
+    def __capacity(self, h):
+        # capacities shrink geometrically from the top level down
+        depth = len(self.__levels) - h - 1
+        return max(2, int(np.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+    def __compress(self):
+        # a new top level lowers the capacities of the levels below it,
+        # so compact until all levels fit
+        h = 0
+        while h < len(self.__levels):
+            items = self.__levels[h]
+            if items.shape[0] <= self.__capacity(h):
+                h += 1
+            else:
+                levels = len(self.__levels)
+                items = np.sort(items)
+                # an odd value out stays at this level
+                even = items.shape[0] - items.shape[0] % 2
+                if h + 1 == len(self.__levels):
+                    self.__levels.append(np.zeros(0))
+                self.__levels[h + 1] = np.concatenate((
+                    self.__levels[h + 1],
+                    items[self.__rng.integers(2):even:2]))
+                self.__levels[h] = items[even:]
+                h = 0 if len(self.__levels) > levels else h + 1
+
+    def to_dict(self):
+        return {
+            "k": self.k,
+            "count": self.count,
+            "min": float(self.min),
+            "max": float(self.max),
+            "levels": [items.tolist() for items in self.levels]
+        }
+
+    @staticmethod
+    def from_dict(d, random_seed=None):
+        sketch = QuantileSketch(d["k"], random_seed)
+        sketch.__count = d["count"]
+        sketch.__min = d["min"]
+        sketch.__max = d["max"]
+        sketch.__levels = [np.array(items, dtype=float)
+                           for items in d["levels"]]
+        return sketch
+
+    @staticmethod
+    def sketch_datasource(src, k=200, random_seed=None, workers=None):
+        """Returns a QuantileSketch per dimension of the datasource, built
+           from its chunks in parallel threads and merged in order."""
+        workers = workers or os.cpu_count() or 1
+        seeds = np.random.SeedSequence(random_seed)
+        sketches = [QuantileSketch(k, seed) for seed in
+                    seeds.spawn(len(src.domain))]
+
+        def sketch_chunk(chunk, seed):
+            return [QuantileSketch(k, s).update(col)
+                    for s, col in zip(seed.spawn(chunk.shape[1]), chunk.T)]
+
+        # at most workers chunks are read ahead
+        with ThreadPoolExecutor(workers) as pool:
+            pending = []
+            for chunk in src.iter_chunks():
+                pending.append(pool.submit(sketch_chunk, chunk,
+                                           seeds.spawn(1)[0]))
+                if len(pending) >= workers:
+                    for sketch, part in zip(sketches,
+                                            pending.pop(0).result()):
+                        sketch.merge(part)
+            for future in pending:
+                for sketch, part in zip(sketches, future.result()):
+                    sketch.merge(part)
+        return sketches
+
@@ -16,18 +16,41 @@ from ingen.binning import Binning_Types
 from ingen.binning import BinningGenerator
 from ingen.binning import Pad_Modes
 
+from ingen.helper import SafeLoader
+
 from ingen.histogram import Pad_Values
 
+from ingen.model import EvaluationCache
 from ingen.model import Interpolation_Modes
 from ingen.model import ModelParams
 from ingen.model import Model
 
+from ingen.batch import BatchModelBuilder
+
 from ingen.bundles import BundleGenerator
+from ingen.bundles import BundleGeneratorCache
+
+from ingen.samplers import Sampling_Modes
+
+from ingen.sketches import QuantileSketch
+
+from ingen.service import BundleService
+from ingen.service import BundleHTTPServer
+from ingen.service import BundleUnixServer
 
 from ingen.kpis import KPIs
 
+from ingen.optimizer import BinningOptimizer
+
 from ingen.plotter import HairyPlotter
 
+# choices of the enum options, by lowercase member name
+BINNING_TYPES = [name.lower() for name, value in
+                 Binning_Types.__members__.items() if value.value < 90]
+PAD_MODES = [mode.name.lower() for mode in Pad_Modes]
+PAD_VALUES = [value.name.lower() for value in Pad_Values]
+INTERPOLATION_MODES = [mode.name.lower() for mode in Interpolation_Modes]
+
 
 def validate_binning_domain(ctx, param, value):
     # domain = None --> return None
@@ -71,7 +94,7 @@ def validate_binning(ctx, param, value):
     if os.path.isfile(value):
         try:
             with open(value, "r") as f:
-                bobj = yaml.load(f)
+                bobj = yaml.load(f, Loader=SafeLoader)
                 return Binning.from_dict(bobj)
         except Exception:
             # raise this if file exists but does not contan a binning
@@ -94,6 +117,23 @@ def validate_binning(ctx, param, value):
                                      'positive floats.' % value)
 
 
+def load_sketches(filenames):
+    """Reads the sketches per dimension saved in each file and merges them."""
+    sketches = None
+    for filename in filenames:
+        with open(filename, "r") as f:
+            parts = [QuantileSketch.from_dict(d) for d in yaml.safe_load(f)]
+        if sketches is None:
+            sketches = parts
+        elif len(parts) != len(sketches):
+            raise Exception("Dimensions of sketches in %s (%d) and previous sketches (%d) mismatch."
+                            % (filename, len(parts), len(sketches)))
+        else:
+            for s, part in zip(sketches, parts):
+                s.merge(part)
+    return sketches
+
+
 @click.group()
 def cli():
     pass
@@ -106,17 +146,19 @@ def generate():
 
 @cli.command(short_help='subcommand to calculate different KPIs',
              name='compare')
+@click.option("--sparse", is_flag=True,
+              help='only store occupied bins, for high-dimensional binnings')
 @click.argument("real", type=click.Path())
 @click.argument("generated", type=click.Path())
 @click.argument("binning", callback=validate_binning)
-def compare(real, generated, binning):
+def compare(sparse, real, generated, binning):
     # datasources checks
     try:
-        real = DataSourceIO.read(real)
+        real = DataSourceIO.read(real, lazy=True)
     except:
         raise click.FileError(real, "does not exist or is not readable.")
     try:
-        generated = DataSourceIO.read(generated)
+        generated = DataSourceIO.read(generated, lazy=True)
     except:
         raise click.FileError(generated, "does not exist or is not readable.")
 
@@ -133,8 +175,8 @@ def compare(real, generated, binning):
             % (binning.dimensions, len(real.domain)))
 
     # histogram datasets
-    real_hist = real.get_histogram(binning)
-    generated_hist = generated.get_histogram(binning)
+    real_hist = real.get_histogram(binning, sparse)
+    generated_hist = generated.get_histogram(binning, sparse)
 
     # calculate KPIs
     kpis = KPIs(real_hist, generated_hist)
@@ -143,6 +185,125 @@ def compare(real, generated, binning):
     click.echo("Q:\t%f\nQNEB:\t%f\nQEB:\t%f" % kpis.quality())
 
 
+@cli.command(short_help='search bin counts under a bundle budget',
+             name='optimize')
+@click.option("--target-quality", type=click.FloatRange(0.0, 1.0),
+    help='binnings fit if this expected best quality is reached within BUDGET, default: 1')
+@click.option("--start", type=click.IntRange(min=2), default=2,
+    help='number of bins per dimension to start from, default: 2')
+@click.option("--max-count", type=click.IntRange(min=2), default=64,
+    help='largest number of bins per dimension, default: 64')
+@click.option("--workers", type=click.IntRange(min=1), default=1,
+    help='number of processes scoring candidates, default: 1')
+@click.option("--padmode", type=click.Choice(PAD_MODES), default='mirror',
+    help='padding mode for 👻 bins, default: mirror')
+@click.option("--padvalue", type=click.Choice(PAD_VALUES), default='neg_copy',
+   help='padding values for 👻 bins, default: neg_copy')
+@click.option("--interpolation", type=click.Choice(INTERPOLATION_MODES),
+   default='linear',
+   help='model interpolation mode, default: linear')
+@click.option("--spread", type=float, default=0.3,
+              help='spread for irregular binning generation')
+@click.option("--prehistogram", type=click.IntRange(min=1),
+              help='for clustered binning, cluster a histogram with this many bins per dimension instead of the datapoints')
+@click.argument("datasource", type=click.Path())
+@click.argument("type", type=click.Choice(BINNING_TYPES))
+@click.argument("budget", type=click.IntRange(min=1))
+@click.argument("output", type=click.Path())
+def optimize(target_quality, start, max_count, workers, padmode, padvalue,
+             interpolation, spread, prehistogram, datasource, type, budget,
+             output):
+    """Searches the number of bins per dimension of a binning of a given
+    TYPE for DATASOURCE: the finest binning whose recommended amount of
+    bundles is at most BUDGET. The binning found is written to OUTPUT in
+    yaml format.
+
+    Each candidate binning is scored in memory: a model is derived from
+    DATASOURCE, and bundles are generated with the binning itself and
+    compared to DATASOURCE, as create model, create bundles and compare
+    would. Each step refines the dimension giving the best quality.
+    """
+    if start > max_count:
+        raise click.BadOptionUsage("start",
+                                   "--start (%d) exceeds --max-count (%d)."
+                                   % (start, max_count))
+
+    # the datasource is read once for all candidates
+    try:
+        source = DataSourceIO.read(datasource)
+    except:
+        raise click.FileError(datasource, "does not exist or is not readable.")
+
+    model_params = ModelParams(
+        Pad_Modes[padmode.upper()],
+        Pad_Values[padvalue.upper()],
+        Interpolation_Modes[interpolation.upper()]
+    )
+
+    optimizer = BinningOptimizer(source, Binning_Types[type.upper()], budget,
+                                 model_params, target_quality,
+                                 spread=spread, prehistogram=prehistogram)
+    binning, score = optimizer.search(start, max_count, workers)
+
+    for candidate in optimizer.history:
+        click.echo("%s:\t%d bins, %s bundles, quality %f%s" % (
+            ",".join(str(c) for c in candidate["counts"]),
+            candidate["bins"],
+            "-" if candidate["amount"] is None else candidate["amount"],
+            candidate["quality"],
+            "" if candidate["fits"] else " (over budget)"))
+
+    if not score["fits"]:
+        raise click.UsageError(
+            "Even %d bins per dimension do not fit in a budget of %d bundles."
+            % (start, budget))
+
+    with open(output, "w") as f:
+        yaml.dump(binning.to_dict(), f)
+    click.echo("Saved binning with %s bins to %s, recommended amount %d, "
+               "quality %f" % (",".join(str(c) for c in binning.counts),
+                               output, score["amount"], score["quality"]))
+
+
+@cli.command(short_help='serve generated bundles to local clients',
+             name='serve')
+@click.option("--host", default="127.0.0.1",
+              help='address to listen on, default: 127.0.0.1')
+@click.option("--port", type=int, default=8080,
+              help='port to listen on, default: 8080')
+@click.option("--socket", type=click.Path(),
+              help='listen on this Unix socket instead of host and port')
+@click.option("--workers", type=click.IntRange(min=1), default=4,
+              help='number of requests handled concurrently, default: 4')
+@click.option("--cache-size", type=click.IntRange(min=1), default=8,
+              help='number of models and generators kept loaded, default: 8')
+def serve(host, port, socket, workers, cache_size):
+    """Serves generated bundles over HTTP, keeping models and generators
+    loaded between requests.
+
+    GET /bundles?model=MODEL&binning=BINNING&amount=AMOUNT returns AMOUNT
+    bundles as CSV, where MODEL and BINNING are paths to previously created
+    files. Optional parameters: seed, sampling (alias, cdf or stratified)
+    and chunk_size. The seed used is returned in the X-Random-Seed header.
+
+    GET /stats returns cache statistics as JSON.
+    """
+    service = BundleService(cache_size)
+    if socket is None:
+        server = BundleHTTPServer((host, port), service, workers)
+        click.echo("Serving bundles on http://%s:%d" % (host, port))
+    else:
+        server = BundleUnixServer(socket, service, workers)
+        click.echo("Serving bundles on %s" % socket)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
 @cli.group(short_help='subcommand to visualize things', name='plot')
 def plot():
     pass
@@ -159,21 +320,35 @@ def g_datasource():
               help='upper limits for dataset domain (float or list of floats)')
 @click.option("--spread", type=float,
               help='spread for irregular binning generation')
-@click.argument("type", type=click.Choice(
-                [name.lower() for name, value in Binning_Types.__members__.items()
-                 if value.value < 90]
-                ))
+@click.option("--prehistogram", type=click.IntRange(min=1),
+              help='for clustered binning, cluster a histogram with this many bins per dimension instead of the datapoints')
+@click.option("--workers", type=click.IntRange(min=1),
+              help='for clustered and quantile binnings, number of threads, default: one per cpu')
+@click.option("--sketch", type=click.Path(exists=True), multiple=True,
+              help='for quantile binning, a previously created sketch to use instead of the datasource; can be repeated to merge sketches')
+@click.argument("type", type=click.Choice(BINNING_TYPES))
 @click.argument("amount", callback=validate_binning_amount)
 @click.argument("output", type=click.Path())
-def g_binning(datasource, domain, type, amount, output, spread):
+def g_binning(datasource, domain, type, amount, output, spread, prehistogram,
+              workers, sketch):
     """Generates a binning of a given type, with AMOUNT bins in each dimension.
     The binning is written to OUTPUT in yaml format.
 
     AMOUNT can be an integer or a comma-separated list of integers, representing
     the number of bins per dimension.
 
-    When not specified, the binning domain is inferred from datasource.
+    When not specified, the binning domain is inferred from datasource, or
+    from the largest values in the sketches.
     """
+    sketches = None
+    if sketch:
+        try:
+            sketches = load_sketches(sketch)
+        except Exception as e:
+            raise click.BadOptionUsage("sketch", str(e))
+        if domain is None and datasource is None:
+            domain = [s.max for s in sketches]
+
     # datasource = None and domain == None --> Error
     # datasource = None and domain != None --> OK
     # datasource != None and domain = None --> derive domain from datasource
@@ -183,7 +358,7 @@ def g_binning(datasource, domain, type, amount, output, spread):
         raise click.UsageError("Either a datasource or a domain is required.")
     elif not datasource is None:
         try:
-            source = DataSourceIO.read(datasource)
+            source = DataSourceIO.read(datasource, lazy=True)
         except:
             raise click.FileError(datasource, "does not exist or is not readable.")
         if not domain is None:
@@ -201,32 +376,106 @@ def g_binning(datasource, domain, type, amount, output, spread):
     if type == Binning_Types.CLUSTERED and datasource is None:
         raise click.UsageError("Datasource is required for clustered binning.")
 
+    # if type is quantile, datasource or sketches are required
+    if type == Binning_Types.QUANTILE and datasource is None and not sketch:
+        raise click.UsageError("Datasource or sketch is required for quantile binning.")
+    if sketches is not None and len(sketches) != len(domain):
+        raise click.BadOptionUsage("sketch",
+                                   "Dimensions of sketches (%d) and domain (%d) mismatch."
+                                   % (len(sketches), len(domain)))
+
     # if spread is not given
     if spread is None:
-        binning = BinningGenerator.generate(type, amount, domain, source)
+        binning = BinningGenerator.generate(type, amount, domain, source,
+                                            prehistogram=prehistogram,
+                                            workers=workers, sketches=sketches)
     else:
-        binning = BinningGenerator.generate(type, amount, domain, source, spread)
+        binning = BinningGenerator.generate(type, amount, domain, source, spread,
+                                            prehistogram, workers, sketches)
 
     with open(output, "w") as f:
         yaml.dump(binning.to_dict(), f)
         click.echo("Saved binning to %s" % output)
 
 
+@generate.command(short_help='sketch datasource quantiles', name='sketch')
+@click.option("--size", type=click.IntRange(min=8), default=200,
+              help='size k of the sketches, their rank error is about 1.7 / k, default: 200')
+@click.option("--workers", type=click.IntRange(min=1),
+              help='number of threads sketching chunks, default: one per cpu')
+@click.argument("datasource", type=click.Path())
+@click.argument("output", type=click.Path())
+def g_sketch(size, workers, datasource, output):
+    """Streams DATASOURCE through a quantile sketch per dimension and writes
+    the sketches to OUTPUT in yaml format.
+
+    Sketches of several datasources, e.g. parts of a trace sketched in
+    parallel, can be merged by passing them all to create binning quantile
+    with --sketch.
+    """
+    try:
+        src = DataSourceIO.read(datasource, lazy=True)
+    except:
+        raise click.FileError(datasource, "does not exist or is not readable.")
+
+    sketches = QuantileSketch.sketch_datasource(src, size, workers=workers)
+    with open(output, "w") as f:
+        yaml.dump([s.to_dict() for s in sketches], f)
+        click.echo("Saved sketches of %d datapoints to %s"
+                   % (sketches[0].count, output))
+
+
+@generate.command(short_help='bin datasource', name='binned')
+@click.argument("datasource", type=click.Path())
+@click.argument("binning", callback=validate_binning)
+@click.argument("output", type=click.Path())
+def g_binned(datasource, binning, output):
+    """Assigns the datapoints of DATASOURCE to the bins of BINNING and writes
+    the number of datapoints in each bin to OUTPUT.bins.csv, with BINNING
+    stored in OUTPUT.yaml. Histogramming OUTPUT with BINNING, e.g. to compare
+    or to derive a model, then reuses the assignment instead of binning the
+    datapoints again; with other binnings, each datapoint is taken to lie on
+    the center of its bin. Datapoints outside BINNING are dropped.
+
+    BINNING can be a path to a previously created binning, or custom bin edges
+    in all dimension: dimensions are separated by colons, edge values in
+    each dimension are separated by commas.
+    """
+    try:
+        src = DataSourceIO.read(datasource, lazy=True)
+    except:
+        raise click.FileError(datasource, "does not exist or is not readable.")
+
+    if binning.dimensions != len(src.domain):
+        raise click.UsageError(
+            "Dimensions of binning (%d) and datasource (%d) mismatch."
+            % (binning.dimensions, len(src.domain)))
+
+    binned = src.to_binned(binning)
+    DataSourceIO.write(binned, output)
+    click.echo("Saved %d datapoints in %d bins to %s"
+               % (binned.counts.sum(), binned.bin_indices.shape[0], output))
+
+
 @generate.command(short_help='derive model', name='model')
-@click.option("--padmode", type=click.Choice([
-   'epsilon', 'mirror']), default='mirror',
+@click.option("--padmode", type=click.Choice(PAD_MODES), default='mirror',
     help='padding mode for 👻 bins, default: mirror')
-@click.option("--padvalue", type=click.Choice([
-   'zero', 'neg_one', 'copy', 'neg_copy']), default='neg_copy',
+@click.option("--padvalue", type=click.Choice(PAD_VALUES), default='neg_copy',
    help='padding values for 👻 bins, default: neg_copy')
-@click.option("--interpolation", type=click.Choice([
-   'linear', 'rbf_linear', 'rbf_multiquad']), default='linear',
+@click.option("--interpolation", type=click.Choice(INTERPOLATION_MODES),
+   default='linear',
    help='model interpolation mode, default: linear')
 @click.option("--resource-names", help='comma-separated list of resource names')
+@click.option("--binary", is_flag=True,
+              help='save the model in the binary npz format, which loads '
+                   'without rebuilding the interpolator')
+@click.option("--sparse", is_flag=True,
+              help='only store occupied bins, for high-dimensional binnings; '
+                   'requires multilinear interpolation')
 @click.argument("datasource", type=click.Path())
 @click.argument("binning", callback=validate_binning)
 @click.argument("output", type=click.Path())
-def g_model(padmode, padvalue, interpolation, resource_names,
+def g_model(padmode, padvalue, interpolation, resource_names, binary, sparse,
             datasource, binning, output):
     """Derives a model from DATASOURCE with given BINNING.
     The model is written to OUTPUT.
@@ -235,9 +484,13 @@ def g_model(padmode, padvalue, interpolation, resource_names,
     in all dimension: dimensions are separated by colons, edge values in
     each dimension are separated by commas.
     """
+    if sparse and interpolation != 'multilinear':
+        raise click.UsageError(
+            "Option --sparse requires --interpolation multilinear.")
+
     # datasource checks
     try:
-        source = DataSourceIO.read(datasource)
+        source = DataSourceIO.read(datasource, lazy=True)
     except:
         raise click.FileError(datasource, "does not exist or is not readable.")
 
@@ -263,77 +516,213 @@ def g_model(padmode, padvalue, interpolation, resource_names,
     )
 
     # histogram the data with given binning
-    histogram = source.get_histogram(binning)
+    histogram = source.get_histogram(binning, sparse)
 
     model = Model.from_histogram(model_params, histogram, resource_names)
-    model.to_file(output)
+    model.to_file(output, binary)
+
+
+@generate.command(short_help='derive models for many parameters',
+                  name='models')
+@click.option("--padmode", type=click.Choice(PAD_MODES), multiple=True,
+    help='padding mode for 👻 bins, repeatable, default: mirror')
+@click.option("--padvalue", type=click.Choice(PAD_VALUES), multiple=True,
+   help='padding values for 👻 bins, repeatable, default: neg_copy')
+@click.option("--interpolation", type=click.Choice(INTERPOLATION_MODES), multiple=True,
+   help='model interpolation mode, repeatable, default: linear')
+@click.option("--resource-names", help='comma-separated list of resource names')
+@click.option("--binary", is_flag=True,
+              help='save the models in the binary npz format')
+@click.option("--workers", type=click.IntRange(min=1), default=1,
+              help='number of processes building models, default: 1')
+@click.argument("datasource", type=click.Path())
+@click.argument("output", type=click.Path(file_okay=False))
+@click.argument("binnings", nargs=-1, required=True)
+def g_models(padmode, padvalue, interpolation, resource_names, binary,
+             workers, datasource, output, binnings):
+    """Derives models from DATASOURCE for every combination of the given
+    padding modes, padding values and interpolation modes, and each of the
+    BINNINGS. The datasource is histogrammed once per binning.
+
+    The models are written to the OUTPUT directory, named after the binning
+    and model params, along with manifest.yaml listing the build time and
+    size of each model.
+
+    Each of BINNINGS can be a path to a previously created binning, or
+    custom bin edges, as for 'create model'.
+    """
+    # datasource checks
+    try:
+        source = DataSourceIO.read(datasource)
+    except:
+        raise click.FileError(datasource, "does not exist or is not readable.")
+
+    # binnings are named after their file, or numbered if given as edges
+    named_binnings = {}
+    for i, value in enumerate(binnings):
+        binning = validate_binning(None, None, value)
+        if binning.dimensions != len(source.domain):
+            raise click.UsageError(
+                "Dimensions of binning %s (%d) and datasource (%d) mismatch."
+                % (value, binning.dimensions, len(source.domain)))
+        name = (os.path.splitext(os.path.basename(value))[0]
+                if os.path.isfile(value) else "binning%d" % i)
+        if name in named_binnings:
+            name = "%s%d" % (name, i)
+        named_binnings[name] = binning
+
+    # resources checks: split list and verify dim match with source
+    if not resource_names is None:
+        resource_names = resource_names.split(",")
+        if len(resource_names) != len(source.column_names):
+            raise click.BadOptionUsage("resource-names",
+            "Dimensions of resource names (%d) and datasource (%d) mismatch."
+            % (len(resource_names), len(source.column_names)))
+
+    model_params = [
+        ModelParams(Pad_Modes[pm.upper()], Pad_Values[pv.upper()],
+                    Interpolation_Modes[im.upper()])
+        for pm in padmode or ['mirror']
+        for pv in padvalue or ['neg_copy']
+        for im in interpolation or ['linear']
+    ]
+
+    builder = BatchModelBuilder(source, named_binnings, model_params,
+                                resource_names)
+    manifest = builder.build(output, workers, binary)
+    for entry in manifest:
+        click.echo("%s: built in %.3fs, %d bytes"
+                   % (entry["model"], entry["build_seconds"], entry["size"]))
 
 
 @generate.command(short_help='generate bundles', name='bundles')
 @click.option("--use-recommended", is_flag=True, default=False,
     help='use recommended amount of bundles instead of given AMOUNT')
+@click.option("--target-quality", type=click.FloatRange(0.0, 1.0),
+    help='use the smallest amount of bundles with this expected best quality')
 @click.option("--print-ebv", is_flag=True, default=False,
     help='print expected best quality for given AMOUNT')
 @click.option("--datasource", type=click.Path(),
     help='path to datasource')
+@click.option("--chunk-size", type=click.IntRange(min=1),
+    help='generate and write bundles in chunks of this size')
+@click.option("--workers", type=click.IntRange(min=1), default=1,
+    help='number of processes generating bundles, default: 1')
+@click.option("--binned", is_flag=True, default=False,
+    help='write bundle counts per bin instead of one row per bundle')
+@click.option("--sampling", type=click.Choice([
+   'alias', 'cdf', 'stratified']), default='alias',
+   help='how bundles are drawn from the bin probabilities, default: alias')
+@click.option("--cache-dir", type=click.Path(file_okay=False),
+    help='directory of compiled generators to reuse across runs')
 @click.argument("model", type=click.Path(exists=True))
 @click.argument("amount", type=int)
 @click.argument("binning", callback=validate_binning)
 @click.argument("output", type=click.Path())
-def g_bundles(use_recommended, print_ebv, datasource,
+def g_bundles(use_recommended, target_quality, print_ebv, datasource,
+              chunk_size, workers, binned, sampling, cache_dir,
               model, amount, binning, output):
     """Generates AMOUNT bundles based on MODEL and BINNING.
     The bundles are written to OUTPUT.yaml and OUTPUT.csv.
 
     MODEL has to be a previously generated model file.
 
-    AMOUNT is an integer that is ignored if --use-recommended is provided.
+    AMOUNT is an integer that is ignored if --use-recommended or
+    --target-quality is provided.
+
+    With --chunk-size, bundles are appended to OUTPUT.csv as they are
+    generated, so memory use does not depend on AMOUNT.
+
+    With --workers, AMOUNT is split across a pool of processes, each with
+    its own random stream. It can not be combined with --chunk-size.
+
+    With --binned, the number of bundles in each bin of BINNING is written
+    to OUTPUT.bins.csv instead, with BINNING stored in OUTPUT.yaml. Such
+    datasources can be compared and plotted like any other.
+
+    With --sampling stratified, each bin gets AMOUNT times its probability
+    bundles, rounded up or down at random, grouped by bin.
+
+    With --cache-dir, the generator compiled for MODEL and BINNING is saved
+    to that directory and reused by later runs with the same inputs.
 
     BINNING can be a path to a previously created binning, or custom bin edges
     in all dimension: dimensions are separated by colons, edge values in
     each dimension are separated by commas.
     """
-    # load model
-    try:
-        model = Model.from_file(model)
-    except Exception:
-        # raise this if file exists but does not contan a model
-        raise click.FileError(model, 'malformed model file.')
+    if use_recommended and target_quality is not None:
+        raise click.UsageError("--use-recommended and --target-quality can not be combined.")
 
-    # check dimensions match for binning and model
-    if binning.dimensions != len(model.column_names):
-        raise click.UsageError("Dimensions of binning (%d) and model (%d) mismatch."
-                               % (binning.dimensions, len(model.domain)))
+    if chunk_size is not None and workers > 1:
+        raise click.UsageError("--chunk-size and --workers can not be combined.")
+
+    if binned and (chunk_size is not None or workers > 1):
+        raise click.UsageError("--binned can not be combined with --chunk-size or --workers.")
+
+    def load_model(filename):
+        try:
+            model = Model.from_file(filename)
+        except Exception:
+            # raise this if file exists but does not contan a model
+            raise click.FileError(filename, 'malformed model file.')
+
+        # check dimensions match for binning and model
+        if binning.dimensions != len(model.column_names):
+            raise click.UsageError("Dimensions of binning (%d) and model (%d) mismatch."
+                                   % (binning.dimensions, len(model.column_names)))
+        return model
 
     # if ebv and recommended amount are requested, real datasource is required
     # load datasource and histogram it using the desired binning
-    if use_recommended or print_ebv:
+    if use_recommended or target_quality is not None or print_ebv:
         if datasource is None:
-            raise click.UsageError("Datasource required for --use-recommended and --print-ebv options.")
+            raise click.UsageError("Datasource required for --use-recommended, --target-quality and --print-ebv options.")
         try:
-            source = DataSourceIO.read(datasource)
+            source = DataSourceIO.read(datasource, lazy=True)
         except:
             raise click.FileError(datasource, "does not exist or is not readable.")
         real_histogram = source.get_histogram(binning)
 
     # option to generate uniform prob instead of using model
 
-    # create DatasetGenerator
-    bg = BundleGenerator(model, binning)
+    # create DatasetGenerator, or load it from the cache
+    sampling_mode = Sampling_Modes[sampling.upper()]
+    if cache_dir is None:
+        bg = BundleGenerator(load_model(model), binning,
+                             sampling_mode=sampling_mode)
+    else:
+        bg = BundleGeneratorCache(cache_dir).get(model, binning, load_model,
+                                                 sampling_mode=sampling_mode)
 
     # use recommended amount
     if use_recommended:
         amount = bg.recommended_amount(real_histogram)
         click.echo("Using recommended amount: %d" % amount)
 
+    # use smallest amount reaching the target quality
+    if target_quality is not None:
+        try:
+            amount = bg.recommended_amount(real_histogram, target_quality)
+        except Exception as e:
+            raise click.BadParameter(str(e), param_hint="--target-quality")
+        click.echo("Using recommended amount for target quality %f: %d"
+                   % (target_quality, amount))
+
     # print ebv
     if print_ebv:
         ebv = bg.expected_best_quality(amount, real_histogram)
         click.echo("Expected best quality: %f" % ebv)
 
     # generate bundles and save to OUTPUT
-    bundles = bg.generate(amount)
-    DataSourceIO.write(bundles, output)
+    if binned:
+        bundles = bg.generate_binned(amount)
+        DataSourceIO.write(bundles, output)
+    elif chunk_size is None:
+        bundles = bg.generate(amount, workers=workers)
+        DataSourceIO.write(bundles, output)
+    else:
+        bundles = bg.generate_stream(amount, chunk_size)
+        DataSourceIO.write_stream(bundles, output)
 
 
 class G_DATASOURCE():
@@ -432,7 +821,7 @@ def p_data(show, cmap, title, resource_names, datasource, binning, output):
             % cmap)
 
     try:
-        source = DataSourceIO.read(datasource)
+        source = DataSourceIO.read(datasource, lazy=True)
     except:
         raise click.FileError(datasource, "does not exist or is not readable.")
 
@@ -471,10 +860,13 @@ def p_data(show, cmap, title, resource_names, datasource, binning, output):
 @click.option("--cmap", default='Blues', help='matplotlib colormap name')
 @click.option("--title", help='title to be displayed above figure')
 @click.option("--resource-names", help='comma-separated list of resource names')
+@click.option("--cache-dir", type=click.Path(file_okay=False),
+    help='directory of model evaluations to reuse across runs')
 @click.argument("model", type=click.Path(exists=True))
 @click.argument("binning", callback=validate_binning)
 @click.argument("output", type=click.Path())
-def p_model(show, cmap, title, resource_names, model, binning, output):
+def p_model(show, cmap, title, resource_names, cache_dir, model, binning,
+            output):
     """Plots probabilities derived by MODEL, histogrammed using BINNING.
     The figure is saved to OUTPUT.png.
 
@@ -497,6 +889,8 @@ def p_model(show, cmap, title, resource_names, model, binning, output):
     except Exception:
         # raise this if file exists but does not contan a model
         raise click.FileError(model, 'malformed model file.')
+    if cache_dir:
+        model.cache = EvaluationCache(directory=cache_dir)
 
     # check dimensions match for binning and model
     if binning.dimensions != len(model.column_names):
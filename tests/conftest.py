@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from ingen.binning import Pad_Modes
+from ingen.bundles import BundleGenerator
+from ingen.helper import objectview
+from ingen.histogram import HistogramEngine
+from ingen.histogram import Pad_Values
+from ingen.model import Interpolation_Modes
+from ingen.model import Model
+from ingen.model import ModelParams
+from ingen.preprocessors import DataSource
+
+
+@pytest.fixture
+def data():
+    """Two clusters of datapoints in [0, 1]^2."""
+    rng = np.random.default_rng(7)
+    return np.clip(np.concatenate([
+        rng.normal((0.3, 0.6), 0.1, (3000, 2)),
+        rng.normal((0.7, 0.2), 0.05, (2000, 2))]), 0.0, 1.0)
+
+
+@pytest.fixture
+def datasource(data):
+    return DataSource(objectview({}), [1.0, 1.0], ["a", "b"], data)
+
+
+@pytest.fixture
+def model_params():
+    return ModelParams(Pad_Modes.MIRROR, Pad_Values.NEG_COPY,
+                       Interpolation_Modes.MULTILINEAR)
+
+
+@pytest.fixture
+def make_histogram(data):
+    """Returns the density histogram of data in a binning."""
+    def make(binning):
+        engine = HistogramEngine(binning)
+        engine.add(data)
+        return engine.histogram()
+    return make
+
+
+@pytest.fixture
+def make_model(make_histogram, model_params):
+    """Returns the model of data in a binning, with model_params or the
+       given interpolation mode."""
+    def make(binning, interpolation_mode=None):
+        params = model_params
+        if interpolation_mode is not None:
+            params = ModelParams(params.pad_mode, params.pad_value,
+                                 interpolation_mode)
+        histogram = make_histogram(binning)
+        histogram.normalize()
+        return Model.from_histogram(params, histogram, ["a", "b"])
+    return make
+
+
+@pytest.fixture
+def make_generator(make_model):
+    """Returns the bundle generator of the model of data in model_binning,
+       for binning."""
+    def make(model_binning, binning, **kwargs):
+        return BundleGenerator(make_model(model_binning), binning, **kwargs)
+    return make
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+
+from ingen import interpolators
+from ingen.batch import BatchModelBuilder
+from ingen.binning import Pad_Modes
+from ingen.binning import RegularBinning
+from ingen.histogram import Pad_Values
+from ingen.model import Interpolation_Modes
+from ingen.model import Model
+from ingen.model import ModelParams
+
+
+def test_models_match_single_builds(datasource, tmp_path):
+    binning = RegularBinning([5, 4], [1.0, 1.0])
+    params = [ModelParams(Pad_Modes.MIRROR, Pad_Values.NEG_COPY, mode)
+              for mode in (Interpolation_Modes.MULTILINEAR,
+                           Interpolation_Modes.LINEAR)]
+    builder = BatchModelBuilder(datasource, {"b": binning}, params, ["x", "y"])
+    manifest = builder.build(str(tmp_path), binary=True)
+
+    assert len(manifest) == 2
+    probe = RegularBinning([9, 7], [1.0, 1.0])
+    for entry, model_params in zip(manifest, params):
+        built = Model.from_file(os.path.join(str(tmp_path), entry["model"]))
+        single = Model.from_histogram(model_params,
+                                      datasource.get_histogram(binning),
+                                      ["x", "y"])
+        np.testing.assert_allclose(built.evaluate(probe),
+                                   single.evaluate(probe))
+
+
+def test_binary_models_are_not_interpolated(datasource, tmp_path, monkeypatch):
+    # npz files do not hold F, so building one must not triangulate
+    monkeypatch.setattr(interpolators, "Delaunay", None)
+    params = [ModelParams(Pad_Modes.MIRROR, Pad_Values.NEG_COPY,
+                          Interpolation_Modes.LINEAR)]
+    builder = BatchModelBuilder(
+        datasource, {"b": RegularBinning([7, 6], [1.0, 1.0])}, params)
+    manifest = builder.build(str(tmp_path), binary=True)
+    assert os.path.isfile(os.path.join(str(tmp_path), manifest[0]["model"]))
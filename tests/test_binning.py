@@ -0,0 +1,120 @@
+import itertools
+import pickle
+
+import numpy as np
+import pytest
+
+from ingen.binning import ClusteredBinning
+from ingen.binning import IrregularBinning
+from ingen.binning import kmeans_1d
+from ingen.preprocessors import DataSource
+
+
+@pytest.fixture
+def binning():
+    np.random.seed(0)
+    return IrregularBinning([4, 3], [1.0, 2.0])
+
+
+def test_cached_arrays_are_read_only(binning):
+    with pytest.raises(ValueError):
+        binning.volumes[0, 0] = 99
+    with pytest.raises(ValueError):
+        binning.centers[0][0] = -1
+    with pytest.raises(ValueError):
+        binning.distances[1][0] = 0
+    with pytest.raises(ValueError):
+        binning.edges[0][0] = 5
+    with pytest.raises(TypeError):
+        binning.centers[0] = np.zeros(4)
+    with pytest.raises(AttributeError):
+        binning.counts.append(7)
+    assert binning.counts == (4, 3)
+    assert isinstance(binning.domain, tuple)
+
+
+def test_copy_is_independent(binning):
+    volumes = binning.volumes.copy()
+    copy = binning.copy()
+    assert copy.volumes is binning.volumes
+    # values computed by one binning after the copy stay its own
+    copy_meshgrids = copy.meshgrids
+    assert binning.meshgrids is not copy_meshgrids
+    np.testing.assert_array_equal(copy.volumes, volumes)
+    assert copy.counts == binning.counts
+
+
+def test_pickle_round_trip(binning):
+    binning.volumes
+    clone = pickle.loads(pickle.dumps(binning))
+    assert clone.digest == binning.digest
+    np.testing.assert_array_equal(clone.volumes, binning.volumes)
+    assert not clone.volumes.flags.writeable
+
+
+def clustering_cost(values, weights, centers):
+    # optimal clusters are contiguous, each value goes to its closest center
+    distances = (values[:, None] - np.asarray(centers)[None, :]) ** 2
+    return (weights * distances.min(axis=1)).sum()
+
+
+def brute_force_cost(values, weights, count):
+    # least cost over all partitions into count contiguous clusters
+    best = np.inf
+    for cuts in itertools.combinations(range(1, values.shape[0]), count - 1):
+        bounds = (0,) + cuts + (values.shape[0],)
+        cost = 0.0
+        for j, i in zip(bounds, bounds[1:]):
+            center = np.average(values[j:i], weights=weights[j:i])
+            cost += (weights[j:i] * (values[j:i] - center) ** 2).sum()
+        best = min(best, cost)
+    return best
+
+
+def dp_cost(values, weights, count):
+    # the O(count n^2) dynamic program
+    n = values.shape[0]
+    cluster = np.full((n + 1, n + 1), np.inf)
+    for j in range(n):
+        for i in range(j + 1, n + 1):
+            center = np.average(values[j:i], weights=weights[j:i])
+            cluster[j, i] = (weights[j:i] * (values[j:i] - center) ** 2).sum()
+    best = cluster[0]
+    for _ in range(count - 1):
+        best = (best[:, None] + cluster).min(axis=0)
+    return best[n]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("count", [1, 2, 3, 5])
+def test_kmeans_1d_is_optimal(seed, count):
+    rng = np.random.default_rng(seed)
+    values = np.unique(np.round(rng.exponential(1.0, 11), 3))
+    weights = rng.integers(1, 20, values.shape[0]).astype(float)
+    centers = kmeans_1d(values, weights, count)
+    assert centers.shape[0] == min(count, values.shape[0])
+    assert np.all(np.diff(centers) > 0)
+    assert clustering_cost(values, weights, centers) == pytest.approx(
+        brute_force_cost(values, weights, count), rel=1e-9, abs=1e-12)
+
+
+def test_kmeans_1d_matches_the_quadratic_program():
+    rng = np.random.default_rng(8)
+    values = np.unique(np.concatenate([rng.normal(0, 1, 80),
+                                       rng.normal(6, 0.3, 80)]))
+    weights = rng.random(values.shape[0]) + 0.1
+    for count in (4, 9):
+        centers = kmeans_1d(values, weights, count)
+        assert clustering_cost(values, weights, centers) == pytest.approx(
+            dp_cost(values, weights, count), rel=1e-9)
+
+
+def test_clustered_binning_from_prehistogram():
+    data = np.random.default_rng(9).beta(2, 5, (5000, 2))
+    src = DataSource(None, [1.0, 1.0], None, data)
+    for prehistogram in (None, 256):
+        binning = ClusteredBinning([6, 4], src, prehistogram)
+        assert binning.counts == (6, 4)
+        for edges in binning.edges:
+            assert edges[0] == 0.0 and edges[-1] == 1.0
+            assert np.all(np.diff(edges) > 0)
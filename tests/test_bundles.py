@@ -0,0 +1,188 @@
+import os
+
+import numpy as np
+import pytest
+
+from ingen.binning import Binning
+from ingen.binning import Binning_Types
+from ingen.binning import IrregularBinning
+from ingen.binning import RegularBinning
+from ingen.bundles import BundleGeneratorCache
+from ingen.histogram import SparseHistogram
+from ingen.preprocessors import DataSource
+from ingen.preprocessors import DataSourceIO
+from ingen.samplers import Sampling_Modes
+
+
+def loop_sums(bg):
+    # the probability of each bin before normalization, computed one bin
+    # at a time as before the batched engine
+    all_edges = [np.unique(np.concatenate((gbe, mbe))) for gbe, mbe
+                 in zip(bg.binning.edges, bg.model.binning.edges)]
+    sums = np.zeros(int(np.prod(bg.binning.counts)))
+    for i, bin_index in enumerate(np.ndindex(*bg.binning.counts)):
+        sub_binning = Binning(Binning_Types.SUBBINNING, [
+            edges[(edges >= coarse[idx]) * (edges <= coarse[idx + 1])]
+            for edges, coarse, idx in zip(all_edges, bg.binning.edges,
+                                          bin_index)])
+        factors = sub_binning.volumes / sub_binning.total_volume
+        alltF = bg.model.F(*sub_binning.meshgrids).flatten()
+        alltF = [x if x > 0.0 else 0.0 for x in alltF]
+        sums[i] = sum(alltF * factors.flatten())
+    return sums
+
+
+@pytest.mark.parametrize("chunk_size", [1, 50, 2**20])
+def test_probabilities_match_the_loop(make_generator, chunk_size):
+    np.random.seed(6)
+    binning = IrregularBinning([7, 5], [1.0, 1.0])
+    bg = make_generator(IrregularBinning([6, 4], [1.0, 1.0]), binning,
+                        chunk_size=chunk_size)
+    sums = loop_sums(bg)
+    positive = np.flatnonzero(sums > 0)
+    np.testing.assert_array_equal(bg.bin_indices, positive)
+    np.testing.assert_array_equal(bg.sparse_probabilities[:, :-1],
+                                  binning.bin_centers(positive))
+    # the sums match exactly; normalizing only the positive ones may round
+    # differently than normalizing all of them
+    np.testing.assert_array_equal(
+        bg.sparse_probabilities[:, -1],
+        sums[positive] / np.linalg.norm(sums[positive], ord=1))
+    np.testing.assert_allclose(bg.probabilities[:, -1],
+                               sums / np.linalg.norm(sums, ord=1),
+                               rtol=1e-14, atol=0)
+
+
+def test_probabilities_do_not_depend_on_chunk_size(make_generator):
+    np.random.seed(6)
+    binning = IrregularBinning([9, 8], [1.0, 1.0])
+    model_binning = IrregularBinning([6, 4], [1.0, 1.0])
+    whole = make_generator(model_binning, binning)
+    for chunk_size in (1, 13, 200):
+        chunked = make_generator(model_binning, binning,
+                                 chunk_size=chunk_size)
+        np.testing.assert_array_equal(chunked.bin_indices, whole.bin_indices)
+        np.testing.assert_array_equal(chunked.sparse_probabilities,
+                                      whole.sparse_probabilities)
+
+
+def test_target_quality_one_is_reachable(make_histogram, make_generator):
+    np.random.seed(3)
+    for _ in range(40):
+        binning = IrregularBinning([9, 7], [1.0, 1.0])
+        bg = make_generator(RegularBinning(6, [1.0, 1.0]), binning)
+        real = make_histogram(binning)
+        amount = bg.recommended_amount(real, target_quality=1.0)
+        assert bg.expected_best_quality(amount, real) == 1.0
+        assert bg.expected_best_quality(amount - 1, real) < 1.0
+
+
+def test_sparse_real_histogram_equals_dense(make_histogram, make_generator):
+    np.random.seed(4)
+    binning = IrregularBinning([12, 10], [1.0, 1.0])
+    bg = make_generator(RegularBinning(6, [1.0, 1.0]), binning)
+    dense = make_histogram(binning)
+    sparse = SparseHistogram.from_dense(dense)
+    amounts = np.arange(0, 5000, 7)
+    np.testing.assert_array_equal(
+        bg.expected_best_quality_curve(amounts, sparse),
+        bg.expected_best_quality_curve(amounts, dense))
+    assert bg.recommended_amount(sparse) == bg.recommended_amount(dense)
+    for target in (0.5, 0.9, 1.0):
+        assert (bg.recommended_amount(sparse, target)
+                == bg.recommended_amount(dense, target))
+
+
+@pytest.mark.parametrize("mode", [Sampling_Modes.ALIAS, Sampling_Modes.CDF,
+                                  Sampling_Modes.STRATIFIED])
+@pytest.mark.parametrize("chunk_size", [10, 333, 10000])
+def test_stream_equals_generate(make_generator, mode, chunk_size):
+    binning = RegularBinning(8, [1.0, 1.0])
+    bg = make_generator(RegularBinning(6, [1.0, 1.0]), binning,
+                        sampling_mode=mode)
+    whole = bg.generate(5000, random_seed=123).data
+    stream = bg.generate_stream(5000, chunk_size, random_seed=123)
+    assert np.array_equal(np.concatenate(list(stream)), whole)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 64, 10000])
+def test_streamed_file_equals_written_file(make_generator, tmp_path,
+                                          chunk_size):
+    binning = RegularBinning(8, [1.0, 1.0])
+    bg = make_generator(RegularBinning(6, [1.0, 1.0]), binning)
+    whole = str(tmp_path / "whole")
+    streamed = str(tmp_path / "streamed")
+    DataSourceIO.write(bg.generate(700, random_seed=9), whole)
+    DataSourceIO.write_stream(bg.generate_stream(700, chunk_size,
+                                                 random_seed=9), streamed)
+    with open(whole + ".csv", "rb") as f, open(streamed + ".csv", "rb") as g:
+        assert f.read() == g.read()
+
+
+def test_binned_file_round_trip(make_generator, tmp_path):
+    np.random.seed(3)
+    binning = IrregularBinning([7, 5], [1.0, 1.0])
+    bg = make_generator(RegularBinning(6, [1.0, 1.0]), binning)
+    binned = bg.generate_binned(3000, random_seed=4)
+    filename = str(tmp_path / "binned")
+    DataSourceIO.write(binned, filename)
+    assert not os.path.exists(filename + ".csv")
+    src = DataSourceIO.read(filename)
+
+    assert src.binning.digest == binning.digest
+    np.testing.assert_array_equal(src.bin_indices, binned.bin_indices)
+    np.testing.assert_array_equal(src.counts, binned.counts)
+    assert src.counts.sum() == 3000
+    expanded = DataSource(None, src.domain, src.column_names, src.data)
+    for other in (binning, RegularBinning([4, 3], [1.0, 1.0])):
+        expected = expanded.get_histogram(other).values
+        np.testing.assert_array_equal(src.get_histogram(other).values,
+                                      expected)
+        np.testing.assert_array_equal(
+            src.get_histogram(other, sparse=True).to_dense().values,
+            expected)
+
+
+def test_stratified_stream_keeps_quality(make_generator):
+    binning = RegularBinning(8, [1.0, 1.0])
+    bg = make_generator(RegularBinning(6, [1.0, 1.0]), binning,
+                        sampling_mode=Sampling_Modes.STRATIFIED)
+    counts = np.zeros(64, dtype=np.int64)
+    for chunk in bg.generate_stream(500, 10, random_seed=5):
+        counts += np.bincount(binning.locate(chunk), minlength=64)
+    expected = np.zeros(64)
+    expected[bg.bin_indices] = bg.sparse_probabilities[:, -1] * 500
+    assert np.all(np.abs(counts - expected) < 1)
+
+
+def test_generator_cache_round_trip(make_generator, tmp_path):
+    model_filename = str(tmp_path / "model")
+    with open(model_filename, "w") as f:
+        f.write("model")
+    binning = RegularBinning([6, 5], [1.0, 1.0])
+    bg = make_generator(RegularBinning([4, 4], [1.0, 1.0]), binning)
+    cache = BundleGeneratorCache(str(tmp_path / "cache"))
+
+    built = cache.get(model_filename, binning, lambda f: bg.model)
+    assert os.listdir(cache.directory) == [
+        os.path.basename(cache.filename(model_filename, binning))]
+    loaded = cache.get(model_filename, binning, None)
+    np.testing.assert_array_equal(loaded.sparse_probabilities,
+                                  built.sparse_probabilities)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_generate_is_deterministic(make_generator, workers):
+    binning = RegularBinning(8, [1.0, 1.0])
+    bg = make_generator(RegularBinning(6, [1.0, 1.0]), binning)
+    for seed in (0, 42):
+        first = bg.generate(1001, random_seed=seed, workers=workers)
+        second = bg.generate(1001, random_seed=seed, workers=workers)
+        np.testing.assert_array_equal(first.data, second.data)
+        assert first.info.random_seed == seed
+        assert first.info.worker_amounts == (
+            [1001] if workers == 1 else [334, 334, 333])
+        uniform = bg.generate_uniform(100, random_seed=seed, workers=workers)
+        np.testing.assert_array_equal(
+            uniform.data,
+            bg.generate_uniform(100, random_seed=seed, workers=workers).data)
@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+from ingen.helper import atomic_write
+
+
+def test_atomic_write_replaces_the_file(tmp_path):
+    filename = str(tmp_path / "entry.npy")
+    with atomic_write(filename) as tmpname:
+        assert tmpname.endswith(".npy")
+        assert not os.path.exists(filename)
+        with open(tmpname, "w") as f:
+            f.write("done")
+    with open(filename) as f:
+        assert f.read() == "done"
+    assert os.listdir(tmp_path) == ["entry.npy"]
+
+
+def test_atomic_write_cleans_up_on_error(tmp_path):
+    filename = str(tmp_path / "entry.npy")
+    with open(filename, "w") as f:
+        f.write("old")
+    with pytest.raises(ValueError):
+        with atomic_write(filename) as tmpname:
+            with open(tmpname, "w") as f:
+                f.write("partial")
+            raise ValueError()
+    with open(filename) as f:
+        assert f.read() == "old"
+    assert os.listdir(tmp_path) == ["entry.npy"]
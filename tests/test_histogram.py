@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+
+from ingen.binning import G2ProgressionBinning
+from ingen.binning import IrregularBinning
+from ingen.binning import Pad_Modes
+from ingen.binning import RegularBinning
+from ingen.histogram import HistogramEngine
+from ingen.histogram import HistogramExtender
+from ingen.histogram import Pad_Values
+from ingen.histogram import SparseHistogram
+from ingen.kpis import KPIs
+from ingen.model import Interpolation_Modes
+from ingen.model import Model
+from ingen.model import ModelParams
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(11)
+    # outliers on both sides, and points exactly on the edges
+    points = rng.uniform(-0.1, 1.1, (20000, 3))
+    points[:300] = np.round(points[:300] * 8) / 8
+    points[300:310] = 1.0
+    return points
+
+
+def binnings():
+    np.random.seed(12)
+    return [RegularBinning([8, 5, 3], [1.0] * 3),
+            IrregularBinning([7, 4, 6], [1.0] * 3),
+            G2ProgressionBinning([5, 5, 5], [1.0] * 3)]
+
+
+@pytest.mark.parametrize("binning", binnings())
+@pytest.mark.parametrize("chunk_size,workers", [(2**20, 1), (999, 4),
+                                                (1, 1)])
+def test_engine_equals_histogramdd(data, binning, chunk_size, workers):
+    if chunk_size == 1:
+        data = data[:500]
+    expected, _ = np.histogramdd(data, bins=binning.edges, density=True)
+    engine = HistogramEngine(binning, chunk_size, workers)
+    engine.add(data)
+    np.testing.assert_array_equal(engine.histogram().values, expected)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_weighted_adds_equal_histogramdd(data, workers):
+    binning = binnings()[1]
+    weights = np.random.default_rng(13).integers(0, 5, data.shape[0])
+    expected, _ = np.histogramdd(data, bins=binning.edges, weights=weights,
+                                 density=True)
+    engine = HistogramEngine(binning, 777, workers)
+    for rows in np.array_split(np.arange(data.shape[0]), 5):
+        engine.add(data[rows], weights[rows])
+    np.testing.assert_array_equal(engine.histogram().values, expected)
+
+
+@pytest.mark.parametrize("binning", binnings())
+def test_sparse_engine_equals_dense(data, binning):
+    dense = HistogramEngine(binning)
+    sparse = HistogramEngine(binning, 999, 4, sparse=True)
+    for chunk in np.array_split(data, 7):
+        dense.add(chunk)
+        sparse.add(chunk)
+    np.testing.assert_array_equal(sparse.histogram().to_dense().values,
+                                  dense.histogram().values)
+
+
+def corner_histogram():
+    # occupied bins on faces, edges and corners of the grid
+    binning = RegularBinning([4, 5, 3], [1.0] * 3)
+    points = np.random.default_rng(13).random((40, 3))
+    points[:8] = [[x, y, z] for x in (0.0, 0.99) for y in (0.0, 0.99)
+                  for z in (0.0, 0.99)]
+    engine = HistogramEngine(binning)
+    engine.add(points)
+    return engine.histogram()
+
+
+@pytest.mark.parametrize("pad_mode", list(Pad_Modes))
+@pytest.mark.parametrize("pad_value", list(Pad_Values))
+def test_sparse_extension_equals_dense(pad_mode, pad_value):
+    dense = corner_histogram()
+    sparse = SparseHistogram.from_dense(dense)
+    extended = HistogramExtender.extend(dense, pad_mode, pad_value)
+    extended_sparse = HistogramExtender.extend(sparse, pad_mode, pad_value)
+    assert extended_sparse.binning.digest == extended.binning.digest
+    np.testing.assert_array_equal(extended_sparse.to_dense().values,
+                                  extended.values)
+
+
+def test_sparse_kpis_equal_dense():
+    dense = corner_histogram()
+    other = HistogramEngine(dense.binning)
+    other.add(np.random.default_rng(14).random((60, 3)))
+    other = other.histogram()
+    expected = KPIs(dense, other)
+    actual = KPIs(SparseHistogram.from_dense(dense), other)
+    assert actual.error() == pytest.approx(expected.error(), rel=1e-12)
+    np.testing.assert_allclose(actual.quality(), expected.quality(),
+                               rtol=1e-12)
+
+
+@pytest.mark.parametrize("pad_value", list(Pad_Values))
+def test_sparse_model_equals_dense(pad_value):
+    dense = corner_histogram()
+    params = ModelParams(Pad_Modes.MIRROR, pad_value,
+                         Interpolation_Modes.MULTILINEAR)
+    sparse = SparseHistogram.from_dense(dense)
+    np.random.seed(15)
+    probe = IrregularBinning([9, 7, 8], [1.0] * 3)
+    np.testing.assert_allclose(
+        Model.from_histogram(params, sparse).evaluate(probe),
+        Model.from_histogram(params, dense).evaluate(probe),
+        rtol=1e-12, atol=1e-15)
@@ -0,0 +1,106 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from scipy.interpolate import Rbf
+from scipy.interpolate import RegularGridInterpolator
+
+from ingen import interpolators
+from ingen.binning import IrregularBinning
+from ingen.binning import RegularBinning
+from ingen.histogram import Histogram
+from ingen.histogram import SparseHistogram
+from ingen.interpolators import GeometryCache
+from ingen.interpolators import LocalRbfInterpolator
+from ingen.interpolators import MultilinearInterpolator
+from ingen.interpolators import SparseMultilinearInterpolator
+from ingen.interpolators import geometry_cache
+from ingen.model import Interpolation_Modes
+
+
+def grid_queries(axes, count, seed):
+    # points inside the grid, on its nodes and outside of it
+    rng = np.random.default_rng(seed)
+    queries = [rng.uniform(axis[0] - 0.1, axis[-1] + 0.1, count)
+               for axis in axes]
+    for query, axis in zip(queries, axes):
+        query[:axis.shape[0]] = axis
+    return queries
+
+
+def test_multilinear_equals_regular_grid_interpolator():
+    rng = np.random.default_rng(3)
+    axes = [np.sort(rng.random(n)) for n in (5, 4, 6)]
+    values = rng.normal(size=(5, 4, 6))
+    queries = grid_queries(axes, 500, 4)
+    expected = RegularGridInterpolator(axes, values, bounds_error=False)(
+        np.stack(queries, axis=-1))
+    np.testing.assert_allclose(MultilinearInterpolator(axes, values)(
+        *queries), expected, rtol=1e-12, atol=1e-12)
+
+
+def test_sparse_multilinear_equals_regular_grid_interpolator():
+    np.random.seed(5)
+    binning = IrregularBinning([6, 5, 4], [1.0] * 3)
+    rng = np.random.default_rng(6)
+    # mostly empty bins
+    values = rng.random(binning.counts) * (rng.random(binning.counts) < 0.2)
+    interpolator = SparseMultilinearInterpolator(
+        SparseHistogram.from_dense(Histogram(binning, values)))
+    queries = grid_queries(binning.centers, 500, 7)
+    expected = RegularGridInterpolator(
+        binning.centers, values, bounds_error=False)(
+        np.stack(queries, axis=-1))
+    np.testing.assert_allclose(interpolator(*queries), expected,
+                               rtol=1e-12, atol=1e-12)
+
+
+def test_linear_models_share_the_triangulation(make_model):
+    binning = RegularBinning([5, 4], [1.0, 1.0])
+    first = make_model(binning, Interpolation_Modes.LINEAR)
+    second = make_model(binning, Interpolation_Modes.LINEAR)
+    assert first.F.triangulation is second.F.triangulation
+
+
+def test_pickled_linear_model_keeps_the_triangulation(make_model):
+    model = make_model(RegularBinning([6, 5], [1.0, 1.0]),
+                       Interpolation_Modes.LINEAR)
+    probe = RegularBinning([11, 9], [1.0, 1.0])
+    expected = model.evaluate(probe)
+    misses = geometry_cache.misses
+
+    clone = pickle.loads(pickle.dumps(model.F))
+    # not triangulated again, but shared with the model it was pickled from
+    assert geometry_cache.misses == misses
+    assert clone.triangulation is model.F.triangulation
+    np.testing.assert_array_equal(clone(*probe.meshgrids), expected)
+
+
+def test_unpickling_does_not_triangulate(make_model, monkeypatch):
+    model = make_model(RegularBinning([6, 5], [1.0, 1.0]),
+                       Interpolation_Modes.LINEAR)
+    pickled = pickle.dumps(model.F)
+    # as in a fresh process, where nothing may be triangulated
+    monkeypatch.setattr(interpolators, "geometry_cache", GeometryCache())
+    monkeypatch.setattr(interpolators, "Delaunay", None)
+    first = pickle.loads(pickled)
+    second = pickle.loads(pickled)
+    assert first.triangulation is second.triangulation
+    probe = RegularBinning([11, 9], [1.0, 1.0])
+    np.testing.assert_array_equal(first(*probe.meshgrids),
+                                  model.evaluate(probe))
+
+
+@pytest.mark.parametrize("kernel", ["linear", "multiquadric"])
+def test_local_rbf_with_all_neighbors_equals_rbf(kernel):
+    grid = np.meshgrid(np.linspace(0.0, 1.0, 6), np.linspace(0.0, 2.0, 5),
+                       indexing="ij")
+    values = np.random.default_rng(5).random(grid[0].shape)
+    points = np.stack([g.ravel() for g in grid], axis=-1)
+    local = LocalRbfInterpolator(points, values.ravel(), kernel,
+                                 neighbors=points.shape[0], chunk_size=7)
+    queries = np.random.default_rng(6).random((2, 9, 4)) * [[[1.0]], [[2.0]]]
+    np.testing.assert_allclose(local(*queries),
+                               Rbf(*grid, values, function=kernel)(*queries),
+                               rtol=1e-9, atol=1e-12)
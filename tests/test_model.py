@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import pytest
+
+from ingen.binning import IrregularBinning
+from ingen.binning import RegularBinning
+from ingen.bundles import BundleGenerator
+from ingen.model import EvaluationCache
+
+
+def test_evaluations_are_memoized_on_request(make_model):
+    m = make_model(RegularBinning([5, 4], [1.0, 1.0]))
+    assert m.cache is None
+    binning = RegularBinning([7, 3], [1.0, 1.0])
+    values = m.evaluate(binning)
+
+    m.cache = EvaluationCache()
+    np.testing.assert_array_equal(m.evaluate(binning), values)
+    np.testing.assert_array_equal(m.evaluate(binning), values)
+    assert (m.cache.hits, m.cache.misses) == (1, 1)
+
+
+def test_bundle_generator_bypasses_the_cache(make_model):
+    m = make_model(RegularBinning([5, 4], [1.0, 1.0]))
+    m.cache = EvaluationCache()
+    np.random.seed(0)
+    BundleGenerator(m, IrregularBinning([6, 6], [1.0, 1.0]), chunk_size=7)
+    assert (m.cache.hits, m.cache.misses) == (0, 0)
+
+
+def test_evaluations_are_stored_on_disk(make_model, tmp_path):
+    m = make_model(RegularBinning([5, 4], [1.0, 1.0]))
+    binning = RegularBinning([7, 3], [1.0, 1.0])
+    m.cache = EvaluationCache(directory=str(tmp_path))
+    values = m.evaluate(binning)
+    assert len(os.listdir(tmp_path)) == 1
+
+    m.cache = EvaluationCache(directory=str(tmp_path))
+    np.testing.assert_array_equal(m.evaluate(binning), values)
+    assert m.cache.disk_hits == 1
+
+
+def test_evaluate_into_memmap_equals_evaluate(make_model, tmp_path):
+    m = make_model(RegularBinning([5, 4], [1.0, 1.0]))
+    binning = IrregularBinning([9, 7], [1.0, 1.0])
+    out = np.lib.format.open_memmap(str(tmp_path / "grid.npy"), mode="w+",
+                                    shape=tuple(binning.counts))
+    assert m.evaluate_into(binning.centers, out, chunk_size=10) is out
+    out.flush()
+    np.testing.assert_array_equal(np.load(str(tmp_path / "grid.npy")),
+                                  m.evaluate(binning))
+    with pytest.raises(Exception):
+        m.evaluate_into(binning.centers, np.empty((7, 9)))
+
+
+def test_projections_equal_sums_of_evaluate(make_model):
+    m = make_model(RegularBinning([5, 4], [1.0, 1.0]))
+    np.random.seed(1)
+    axes = [np.sort(np.random.random(n)) for n in (6, 3)]
+    values = m.evaluate_grid(axes)
+    dims = [(0, 1), (1, 0), (0,), (1,), ()]
+    for projection, kept in zip(m.projections(axes, dims, chunk_size=5),
+                                dims):
+        others = tuple(dim for dim in range(2) if dim not in kept)
+        expected = values.sum(axis=others)
+        if kept == (1, 0):
+            expected = expected.T
+        np.testing.assert_allclose(projection, expected, rtol=1e-12)
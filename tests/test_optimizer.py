@@ -0,0 +1,29 @@
+import numpy as np
+
+from ingen.binning import Binning_Types
+from ingen.optimizer import BinningOptimizer
+
+
+def test_target_quality_one_matches_recommended_amount(datasource,
+                                                       model_params):
+    for type in (Binning_Types.REGULAR, Binning_Types.G2PROGRESSION):
+        default = BinningOptimizer(datasource, type, 2000, model_params)
+        target = BinningOptimizer(datasource, type, 2000, model_params,
+                                  target_quality=1.0)
+        candidates = [[i, j] for i in range(2, 12, 3) for j in range(2, 12, 3)]
+        for a, b in zip(default.score(candidates), target.score(candidates)):
+            # ceil(1 / p) may be one less than the smallest amount with
+            # p * amount >= 1, due to rounding
+            assert b["amount"] is not None
+            assert b["amount"] - a["amount"] in (0, 1)
+            assert b["fits"] == (b["amount"] <= 2000)
+
+
+def test_search_fits_budget(datasource, model_params):
+    binning, score = BinningOptimizer(
+        datasource, Binning_Types.REGULAR, 2000, model_params,
+        target_quality=1.0).search(max_count=16)
+    assert score["fits"]
+    assert score["amount"] <= 2000
+    assert score["expected_quality"] == 1.0
+    assert score["bins"] == int(np.prod(binning.counts))
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from ingen.binning import IrregularBinning
+from ingen.histogram import HistogramEngine
+from ingen.preprocessors import DataSource
+from ingen.preprocessors import FileDataSource
+
+
+@pytest.fixture
+def datafile(tmp_path):
+    data = np.random.default_rng(5).random((1000, 3))
+    filename = str(tmp_path / "data.csv")
+    np.savetxt(filename, data, delimiter=",")
+    return filename
+
+
+def test_file_data_is_read_once(datafile):
+    src = FileDataSource(None, [1.0] * 3, None, datafile)
+    assert src.data is src.data
+    np.testing.assert_array_equal(src.data,
+                                  np.loadtxt(datafile, delimiter=","))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 77, 4096])
+def test_chunked_histogram_equals_in_memory(datafile, chunk_size):
+    np.random.seed(2)
+    binning = IrregularBinning([5, 4, 3], [1.0] * 3)
+    src = FileDataSource(None, [1.0] * 3, None, datafile, chunk_size)
+    in_memory = DataSource(None, [1.0] * 3, None, src.data)
+    assert (sum(chunk.shape[0] for chunk in src.iter_chunks())
+            == src.data.shape[0])
+    np.testing.assert_array_equal(src.get_histogram(binning).values,
+                                  in_memory.get_histogram(binning).values)
+    binned = src.to_binned(binning)
+    np.testing.assert_array_equal(
+        binned.get_histogram(binning).values,
+        in_memory.get_histogram(binning).values)
+
+
+def test_engine_spreads_chunks_over_threads():
+    np.random.seed(2)
+    binning = IrregularBinning([6, 6], [1.0, 1.0])
+    data = np.random.default_rng(1).random((1001, 2))
+    engine = HistogramEngine.for_chunks(binning, 1001, workers=4)
+    engine.add(data)
+    reference = HistogramEngine(binning, workers=1)
+    reference.add(data)
+    np.testing.assert_array_equal(engine.counts, reference.counts)
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from ingen.samplers import Sampler
+from ingen.samplers import Sampling_Modes
+
+
+WEIGHTS = np.random.default_rng(0).random(37) ** 3
+
+
+@pytest.mark.parametrize("mode", list(Sampling_Modes))
+@pytest.mark.parametrize("chunk_size", [1, 10, 999, 5000])
+def test_stream_does_not_depend_on_chunk_size(mode, chunk_size):
+    sampler = Sampler.build(mode, WEIGHTS)
+    whole = sampler.sample(5000, np.random.default_rng(42))
+    chunks = list(sampler.stream(5000, np.random.default_rng(42), chunk_size))
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+    assert np.array_equal(np.concatenate(chunks), whole)
+
+
+@pytest.mark.parametrize("mode", list(Sampling_Modes))
+def test_allocate_counts_sample(mode):
+    sampler = Sampler.build(mode, WEIGHTS)
+    counts = sampler.allocate(5000, np.random.default_rng(1), chunk_size=999)
+    indices = sampler.sample(5000, np.random.default_rng(1))
+    if mode != Sampling_Modes.STRATIFIED:
+        assert np.array_equal(counts, np.bincount(indices, minlength=37))
+    assert counts.sum() == 5000
+
+
+def test_stratified_rounds_expected_counts():
+    sampler = Sampler.build(Sampling_Modes.STRATIFIED, WEIGHTS)
+    counts = sampler.allocate(1234, np.random.default_rng(3))
+    expected = sampler.weights * 1234
+    assert counts.sum() == 1234
+    assert np.all((counts == np.floor(expected)) |
+                  (counts == np.ceil(expected)))
+
+
+@pytest.mark.parametrize("mode", list(Sampling_Modes))
+def test_from_tables(mode):
+    sampler = Sampler.build(mode, WEIGHTS)
+    rebuilt = Sampler.from_tables(mode, sampler.tables)
+    assert np.array_equal(sampler.sample(777, np.random.default_rng(9)),
+                          rebuilt.sample(777, np.random.default_rng(9)))
@@ -0,0 +1,83 @@
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+import yaml
+
+from ingen.binning import RegularBinning
+from ingen.service import BundleHTTPServer
+from ingen.service import BundleService
+from ingen.service import BundleUnixServer
+
+
+@pytest.fixture
+def generator(make_generator):
+    return make_generator(RegularBinning([4, 4], [1.0, 1.0]),
+                          RegularBinning([4, 4], [1.0, 1.0]))
+
+
+@pytest.fixture
+def server(generator):
+    service = BundleService()
+    # skip loading model and binning files
+    service.generator = lambda *args: generator
+    server = BundleHTTPServer(("127.0.0.1", 0), service, workers=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def url(server, query):
+    return "http://127.0.0.1:%d/bundles?model=m&binning=b&%s" % (
+        server.server_address[1], query)
+
+
+def test_bundles_are_streamed(server):
+    with urllib.request.urlopen(url(server, "amount=10&chunk_size=3")) as r:
+        assert len(r.read().decode().splitlines()) == 10
+
+
+@pytest.mark.parametrize("query", ["amount=-1", "amount=10&chunk_size=0"])
+def test_invalid_amounts_are_rejected(server, query):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(url(server, query))
+    assert e.value.code == 400
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_bundles_from_model_and_binning_files(make_model, tmp_path, binary):
+    model_file = str(tmp_path / "m.model")
+    binning_file = str(tmp_path / "b.yaml")
+    make_model(RegularBinning([4, 4], [1.0, 1.0])).to_file(model_file, binary)
+    with open(binning_file, "w") as f:
+        yaml.dump(RegularBinning([3, 5], [1.0, 1.0]).to_dict(), f)
+    server = BundleHTTPServer(("127.0.0.1", 0), BundleService(), workers=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        query = "model=%s&binning=%s&amount=10&seed=3" % (model_file,
+                                                          binning_file)
+        address = "http://127.0.0.1:%d/bundles?%s" % (
+            server.server_address[1], query)
+        with urllib.request.urlopen(address) as r:
+            assert r.status == 200
+            assert len(r.read().decode().splitlines()) == 10
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+def test_server_close_releases_resources(tmp_path):
+    path = str(tmp_path / "ingen.sock")
+    server = BundleUnixServer(path, BundleService())
+    assert os.path.exists(path)
+    server.server_close()
+    assert not os.path.exists(path)
+    with pytest.raises(RuntimeError):
+        server.pool.submit(print)
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from ingen.binning import QuantileBinning
+from ingen.preprocessors import DataSource
+from ingen.sketches import QuantileSketch
+
+
+def rank_errors(sketch, values):
+    q = np.linspace(0.0, 1.0, 201)
+    ranks = np.searchsorted(np.sort(values), sketch.quantiles(q),
+                            side='right') / values.shape[0]
+    return np.abs(ranks - q)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_rank_error_is_bounded(seed):
+    values = np.random.default_rng(seed).lognormal(0.0, 1.0, 100000)
+    sketch = QuantileSketch(200, seed)
+    for chunk in np.array_split(values, 37):
+        sketch.update(chunk)
+    errors = rank_errors(sketch, values)
+    # about 1.7 / k with high probability for each quantile
+    assert errors.mean() < 1.0 / sketch.k
+    assert errors.max() < 3.0 / sketch.k
+    assert sketch.count == values.shape[0]
+    assert (sketch.min, sketch.max) == (values.min(), values.max())
+    # the space does not depend on the number of values
+    assert sum(level.shape[0] for level in sketch.levels) < 3 * sketch.k
+
+
+def test_merged_sketches_are_bounded():
+    values = np.random.default_rng(1).normal(0.0, 1.0, 100000)
+    parts = [QuantileSketch(200, seed).update(part) for seed, part
+             in enumerate(np.array_split(values, 8))]
+    merged = QuantileSketch(200, 99)
+    for part in parts:
+        merged.merge(part)
+    errors = rank_errors(merged, values)
+    assert errors.mean() < 1.0 / merged.k
+    assert errors.max() < 3.0 / merged.k
+    assert merged.count == values.shape[0]
+
+    with pytest.raises(Exception):
+        merged.merge(QuantileSketch(100))
+
+
+def test_dict_round_trip():
+    sketch = QuantileSketch(50, 3).update(np.arange(1000.0))
+    clone = QuantileSketch.from_dict(sketch.to_dict())
+    q = np.linspace(0.0, 1.0, 11)
+    np.testing.assert_array_equal(clone.quantiles(q), sketch.quantiles(q))
+
+
+def test_datasource_sketches_do_not_depend_on_workers():
+    data = np.random.default_rng(2).random((5000, 2))
+    src = DataSource(None, [1.0, 1.0], None, data)
+    src.iter_chunks = lambda chunk_size=None: iter(np.array_split(data, 9))
+    q = np.linspace(0.0, 1.0, 21)
+    expected = [s.quantiles(q) for s in
+                QuantileSketch.sketch_datasource(src, 100, 7, workers=1)]
+    for workers in (2, 4):
+        for sketch, values in zip(QuantileSketch.sketch_datasource(
+                src, 100, 7, workers=workers), expected):
+            np.testing.assert_array_equal(sketch.quantiles(q), values)
+
+
+def test_quantile_binning_is_equi_depth():
+    data = np.random.default_rng(3).beta(2, 5, (20000, 2))
+    src = DataSource(None, [1.0, 1.0], None, data)
+    np.random.seed(4)
+    binning = QuantileBinning([10, 5], [1.0, 1.0], src)
+    assert binning.counts == (10, 5)
+    for column, edges in zip(data.T, binning.edges):
+        shares = np.histogram(column, edges)[0] / column.shape[0]
+        assert np.abs(shares - 1.0 / (len(edges) - 1)).max() < 6.0 / 200